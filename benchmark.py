@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# Benchmarks for pedcheck.py, fastpedcheck.py and comparegeno.py on simulated data
+
+from __future__ import division, print_function
+import sys
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+
+def simulate(nanim,nmark,outdir,generations=4,error=0.001,missing=0.01,pederror=0.02,seed=1):
+    """
+        Simulates a multi-generation pedigree with Mendelian inheritance and writes
+          geno.txt:    genotypes as read by the tools (3 info columns, 2 allele columns per marker)
+          truth.txt:   the same genotypes before errors and missing calls were added
+          ped.txt:     pedigree (name, father, mother, family, sex), pederror of the parents are wrong
+          markers.txt: Plink map file with the two alleles of each marker
+        Founders make up the first generation, every later generation has parents drawn from
+        the one before. Returns the file names.
+    """
+    rng = np.random.RandomState(seed)
+    freq = rng.uniform(0.05,0.5,nmark)
+    bases = np.array([rng.permutation(4)[:2]+1 for i in range(nmark)]) # Two of the alleles 1-4 for every marker
+    size = [nanim//generations + (1 if g < nanim % generations else 0) for g in range(generations)]
+    haps = np.zeros((nanim,2,nmark),dtype=np.int8) # Allele 0/1 on each of the two chromosomes
+    names = ['S%d' % i for i in range(nanim)]
+    sex = np.array([1,0]*(nanim//2+1))[:nanim] # '1' male, '0' female as in pedcheck
+    father = np.zeros(nanim,dtype=int)-1
+    mother = np.zeros(nanim,dtype=int)-1
+    start = 0
+    for g,n in enumerate(size):
+        rows = np.arange(start,start+n)
+        if g == 0:
+            haps[rows] = rng.random_sample((n,2,nmark)) < freq
+        else:
+            prev = np.arange(start-size[g-1],start)
+            sires,dams = prev[sex[prev] == 1],prev[sex[prev] == 0]
+            if len(sires) == 0: sires = prev
+            if len(dams) == 0: dams = prev
+            father[rows] = sires[rng.randint(0,len(sires),n)]
+            mother[rows] = dams[rng.randint(0,len(dams),n)]
+            # One of the two alleles of each parent, chosen independently at every marker
+            pick = rng.randint(0,2,(n,2,nmark))
+            cols = np.arange(nmark)
+            haps[rows,0] = haps[father[rows][:,None],pick[:,0],cols]
+            haps[rows,1] = haps[mother[rows][:,None],pick[:,1],cols]
+        start += n
+    calls = np.where(haps,bases[None,None,:,1],bases[None,None,:,0])
+    truth = calls.copy()
+    # Genotyping errors are random calls, missing calls are 0 0
+    wrong = rng.random_sample((nanim,nmark)) < error
+    other = np.where(rng.random_sample((nanim,2,nmark)) < 0.5,bases[None,None,:,1],bases[None,None,:,0])
+    calls[:,0][wrong],calls[:,1][wrong] = other[:,0][wrong],other[:,1][wrong]
+    gone = rng.random_sample((nanim,nmark)) < missing
+    calls[:,0][gone],calls[:,1][gone] = 0,0
+    # Recorded pedigree, a fraction of the known parents replaced by random animals
+    recorded = [father.copy(),mother.copy()]
+    for parents in recorded:
+        swap = (parents >= 0) & (rng.random_sample(nanim) < pederror)
+        parents[swap] = rng.randint(0,nanim,swap.sum())
+    files = {}
+    for key,values in [('geno',calls),('truth',truth)]:
+        files[key] = os.path.join(outdir,key+'.txt')
+        with open(files[key],'w') as fout:
+            fout.write('#\t'+'\t'.join('M%d' % j for j in range(nmark))+'\n')
+            for i in range(nanim):
+                fout.write('%s\t%s\t%s\t' % (names[i],parentName(names,recorded[0][i]),parentName(names,recorded[1][i])))
+                fout.write('\t'.join(np.char.mod('%d',values[i].T.ravel()))+'\n')
+    files['ped'] = os.path.join(outdir,'ped.txt')
+    with open(files['ped'],'w') as fout:
+        for i in range(nanim):
+            fout.write('%s\t%s\t%s\tF\t%d\n' % (names[i],parentName(names,recorded[0][i]),parentName(names,recorded[1][i]),sex[i]))
+    files['markers'] = os.path.join(outdir,'markers.txt')
+    with open(files['markers'],'w') as fout:
+        for j in range(nmark):
+            fout.write('1\tM%d\t0\t%d\t%d\t%d\n' % (j,j+1,bases[j,0],bases[j,1]))
+    return files
+
+def parentName(names,i):
+    if i < 0: return '0'
+    return names[i]
+
+def runTool(cmd):
+    """ Runs a command, returns wall time in seconds, peak memory in MB and the exit status """
+    t = time.time()
+    with open(os.devnull,'w') as null:
+        proc = subprocess.Popen(cmd,stdout=null,stderr=subprocess.PIPE)
+        err = proc.stderr.read()
+        pid,status,usage = os.wait4(proc.pid,0)
+    seconds = time.time()-t
+    if os.WIFEXITED(status): status = os.WEXITSTATUS(status)
+    else: status = -os.WTERMSIG(status)
+    proc.returncode = status
+    rss = usage.ru_maxrss / 1024.0
+    if sys.platform == 'darwin': rss /= 1024.0 # Bytes instead of kB
+    if status != 0: sys.stderr.write('%s failed:\n%s\n' % (' '.join(cmd),err.decode('utf-8','replace')[-2000:]))
+    return seconds,rss,status
+
+def commands(files,outdir,args):
+    """
+        Returns (tool,mode,command,pairs) for every benchmarked run, pairs is the number of
+        pairs of animals the mode compares
+    """
+    n = args.nanim
+    out = os.path.join(outdir,'out.txt')
+    geno,ped = files['geno'],files['ped']
+    extra = args.args.split() if args.args else []
+    pedcheck = [sys.executable,os.path.join(TOOLS,'pedcheck.py'),geno,'-p',ped,'-r',out]+extra
+    runs = [('pedcheck','check',pedcheck+['-o','check'],2*n),
+            ('pedcheck','findparent',pedcheck+['-o','findparent','-l',str(args.limit)],n*(n-1)),
+            ('pedcheck','findped',pedcheck+['-o','findped','-l',str(args.limit)],n*(n-1)),
+            ('pedcheck','dup',pedcheck+['-o','dup','-l',str(100-args.limit)],n*(n-1)//2),
+            ('fastpedcheck','pedcheck',[args.python2,os.path.join(TOOLS,'fastpedcheck.py'),'-i',geno,'-r',out,'-s',out+'.ped','-a',str(args.limit)],2*n),
+            ('comparegeno','animals',[sys.executable,os.path.join(TOOLS,'comparegeno.py'),geno,'-j',files['truth'],'-p',ped,'-m',files['markers'],'-r',out],n),
+            ('comparegeno','markers',[sys.executable,os.path.join(TOOLS,'comparegeno.py'),geno,'-j',files['truth'],'-p',ped,'-m',files['markers'],'-r',out,'-t'],n)]
+    return [run for run in runs if run[0] in args.tools and (not args.modes or run[1] in args.modes)]
+
+def version():
+    # The git commit of the tools, if known
+    try:
+        with open(os.devnull,'w') as null:
+            return subprocess.check_output(['git','describe','--always','--dirty'],cwd=TOOLS,stderr=null).decode('utf-8').strip()
+    except (OSError,subprocess.CalledProcessError):
+        return 'unknown'
+
+def parseSizes(sizes):
+    # Reads a list of ANIMALSxMARKERS sizes, like 500x2000,1000x5000
+    res = []
+    for size in sizes.split(','):
+        nanim,nmark = size.lower().split('x')
+        res.append((int(nanim),int(nmark)))
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the pedcheck tools on simulated data.')
+    parser.add_argument('-o','--output',help='JSON file with the results',default='benchmark.json')
+    parser.add_argument('-s','--sizes',help='Sizes as ANIMALSxMARKERS, comma separated',default='200x2000,500x5000,1000x10000')
+    parser.add_argument('-t','--tools',help='Tools to time (pedcheck,fastpedcheck,comparegeno)',default='pedcheck,fastpedcheck,comparegeno')
+    parser.add_argument('-m','--modes',help='Modes to time, default all (check,findparent,findped,dup,pedcheck,animals,markers)')
+    parser.add_argument('-l',dest='limit',type=float,help='Noise level in percent for the parent searches',default=2.0)
+    parser.add_argument('-g','--generations',type=int,help='Generations in the simulated pedigree',default=4)
+    parser.add_argument('--error',type=float,help='Genotyping error rate',default=0.001)
+    parser.add_argument('--missing',type=float,help='Missing call rate',default=0.01)
+    parser.add_argument('--ped-error',type=float,help='Rate of wrong parents in the recorded pedigree',default=0.02)
+    parser.add_argument('--seed',type=int,help='Seed of the simulation',default=1)
+    parser.add_argument('--repeat',type=int,help='Runs of every command, the fastest is kept',default=1)
+    parser.add_argument('--args',help='Extra arguments for pedcheck.py, like "-s int8 -w 4"')
+    parser.add_argument('--python2',help='Python 2 interpreter for fastpedcheck.py',default='python2')
+    parser.add_argument('--keep',help='Keep the simulated files in this directory')
+    args = parser.parse_args()
+    args.tools = args.tools.split(',')
+    if args.modes: args.modes = args.modes.split(',')
+    results = {'version':version(),'python':sys.version.split()[0],'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+               'args':args.args or '','limit':args.limit,'error':args.error,'missing':args.missing,
+               'pederror':args.ped_error,'generations':args.generations,'seed':args.seed,'runs':[]}
+    for nanim,nmark in parseSizes(args.sizes):
+        outdir = tempfile.mkdtemp(prefix='pedbench')
+        try:
+            t = time.time()
+            files = simulate(nanim,nmark,outdir,args.generations,args.error,args.missing,args.ped_error,args.seed)
+            sys.stdout.write('Simulated %d animals and %d markers in %.1f s\n' % (nanim,nmark,time.time()-t))
+            args.nanim = nanim
+            for tool,mode,cmd,pairs in commands(files,outdir,args):
+                best,failed = None,None
+                for k in range(args.repeat):
+                    try: seconds,rss,status = runTool(cmd)
+                    except OSError as e:
+                        sys.stderr.write('%s: %s\n' % (cmd[0],e))
+                        seconds,rss,status = 0.0,0.0,-1
+                    if status != 0: failed = (seconds,rss,status)
+                    elif best is None or seconds < best[0]: best = (seconds,rss,status)
+                # The fastest successful run, a failure only if every run failed
+                seconds,rss,status = best if best is not None else failed
+                run = {'tool':tool,'mode':mode,'animals':nanim,'markers':nmark,'seconds':round(seconds,4),
+                       'pairs_per_s':round(pairs / seconds,1) if seconds > 0 else 0,
+                       'genotypes_per_s':round(nanim*nmark / seconds,1) if seconds > 0 else 0,
+                       'maxrss_mb':round(rss,1),'status':status}
+                results['runs'].append(run)
+                sys.stdout.write('%-12s %-10s %6d x %-7d %9.3f s %12.0f pairs/s %14.0f genotypes/s %8.1f MB%s\n' %
+                                 (tool,mode,nanim,nmark,seconds,run['pairs_per_s'],run['genotypes_per_s'],rss,'' if status == 0 else '  FAILED'))
+            if args.keep:
+                if not os.path.isdir(args.keep): os.makedirs(args.keep)
+                for key in files: shutil.copy(files[key],os.path.join(args.keep,'%dx%d_%s.txt' % (nanim,nmark,key)))
+        finally:
+            shutil.rmtree(outdir)
+    with open(args.output,'w') as fout:
+        json.dump(results,fout,indent=1,sort_keys=True)
+        fout.write('\n')
+
+if __name__ == '__main__':
+    main()
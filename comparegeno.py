@@ -7,17 +7,28 @@ import sys
 import argparse
 import gzip
 import numpy as np
+import libSNP
 
 class SNP(object):
 
-    def __init__(self,informat,verbose):
+    def __init__(self,informat,verbose,store='float'):
         """
             ic = number of information columns before genotypes start
             ia = allele representation, 1 = 0/1/2, 2 = 11/13/33, 3 = 1 1/1 3/3 3
                  for 2 and 3, alleles are represented as 1/2/3/4
+            store = genotype storage, 'float' keeps one float per call with nan for missing,
+                    'int8' keeps one byte per call with libSNP.MISSING for missing
         """
         self.verbose = verbose
         self.sep = '\t'
+        if store not in ['float','int8']:
+            sys.stderr.write('Unknown genotype store: "%s"\n' % store)
+            sys.exit(1)
+        self.dtype = np.int8 if store == 'int8' else np.float64
+        self.missing = libSNP.MISSING if store == 'int8' else np.nan
+        self.cache = None # libSNP.GenoCache for parsed genotype files
+        self.cached = {} # Cache entries used in this run
+        self.rebuild = False # Parse the genotype files again and replace the cache entries
         if informat.lower() == 'geno':
             self.ic = 3
             self.ia = 3
@@ -84,38 +95,23 @@ class SNP(object):
           1 1/1 3/3 3 (-a 3)
         """
         if referencefile:
-            self.gen = np.zeros((len(self.ped),len(self.mark)))
-            self.gen1 = np.zeros((len(self.ped),len(self.mark)))
-            self.gen1[:] = np.nan
-        else: self.gen = np.zeros((len(self.ped),len(self.mark)))
-        self.gen[:] = np.nan
+            self.gen = np.zeros((len(self.ped),len(self.mark)),dtype=self.dtype)
+            self.gen1 = np.zeros((len(self.ped),len(self.mark)),dtype=self.dtype)
+            self.gen1[:] = self.missing
+        else: self.gen = np.zeros((len(self.ped),len(self.mark)),dtype=self.dtype)
+        self.gen[:] = self.missing
+        self.readGenoFile(genofile,self.gen)
+        if not referencefile: return
+        self.readGenoFile(referencefile,self.gen1)
+
+    def readGenoFile(self,genofile,gen):
+        # Fills in the rows of the pedigree samples found in one genotype file
+        if self.cache:
+            self.readCached(self.cacheEntry(genofile),gen)
+            return
         if genofile.rsplit('.',1)[1] == 'gz': op = gzip.open
         else: op = open
         with op(genofile,'r') as fin:
-            for line in fin:
-                if line.startswith('#'):
-                    mlist = line.strip('#').strip().split()
-                    continue
-                l = line.strip().split()
-                if len(l) < 1: continue
-                try: irow = self.ped[l[self.nc]]['rank']
-                except KeyError: continue
-                for i,mark  in enumerate(mlist):
-                    if mark not in self.mark: continue
-                    icol = self.mark[mark]['rank']
-                    if self.ia == 1:
-                        a = l[i+self.ic]
-                    elif self.ia == 2: 
-                        a = self.tbase012(l[i+self.ic],mark)
-                    elif self.ia == 3:
-                        a = self.tbase012(l[i*2+self.ic]+l[i*2+1+self.ic],mark)
-                    if a not in ['0','1','2']: a = np.nan
-                    else: a = int(a)
-                    self.gen[irow,icol] = a-1
-        if not referencefile: return
-        if referencefile.rsplit('.',1)[1] == 'gz': op = gzip.open
-        else: op = open
-        with op(referencefile,'r') as fin:
             for line in fin:
                 if line.startswith('#'):
                     mlist = line.strip('#').strip().split()
@@ -133,9 +129,58 @@ class SNP(object):
                         a = self.tbase012(l[i+self.ic],mark)
                     elif self.ia == 3:
                         a = self.tbase012(l[i*2+self.ic]+l[i*2+1+self.ic],mark)
-                    if a not in ['0','1','2']: a = np.nan
-                    else: a = int(a)
-                    self.gen1[irow,icol] = a-1
+                    if a not in ['0','1','2']: gen[irow,icol] = self.missing
+                    else: gen[irow,icol] = int(a)-1
+
+    def cacheEntry(self,genofile):
+        # Returns the parsed genotype file from the cache, parsing and storing it first if needed
+        if genofile in self.cached: return self.cached[genofile]
+        options = {'ic':self.ic,'ia':self.ia,'nc':self.nc}
+        entry = None
+        if not self.rebuild: entry = self.cache.load(genofile,options)
+        if entry is None:
+            entry = libSNP.readGenoFile(genofile,self.ic,self.ia,self.nc)
+            self.cache.save(genofile,options,entry)
+        self.cached[genofile] = entry
+        return entry
+
+    def readCached(self,entry,gen):
+        """
+            Fills in the rows of the pedigree samples in a cached genotype file
+            The cached calls are coded with the alleles found in that file alone, they
+            are recoded through tbase012 to the alleles already known for each marker
+            Calls with a third allele in that file are recoded one by one
+        """
+        keep = [j for j,mark in enumerate(entry['markers']) if mark in self.mark]
+        icols = np.array([self.mark[entry['markers'][j]]['rank'] for j in keep],dtype=int)
+        # Codes given to cached hom-ref and hom-alt calls
+        codes = np.zeros((2,len(keep)))
+        codes[0],codes[1] = -1,1
+        if self.ia != 1:
+            for i,j in enumerate(keep):
+                mark,found = entry['markers'][j],entry['alleles'][j]
+                if len(self.mark[mark]['alleles']) == 0:
+                    self.mark[mark]['alleles'] = list(found)
+                    continue
+                for k,allele in enumerate(found):
+                    a = self.tbase012(allele+allele,mark)
+                    if a not in ['0','1','2']: codes[k,i] = np.nan
+                    else: codes[k,i] = int(a)-1
+        samples = [(i,self.ped[sample]['rank']) for i,sample in enumerate(entry['samples']) if sample in self.ped]
+        for start in range(0,len(samples),256):
+            irows = np.array([i for i,irow in samples[start:start+256]],dtype=int)
+            block = entry['genos'][irows][:,keep]
+            vals = np.where(block == -1,codes[0],np.where(block == 1,codes[1],0.0))
+            vals[block == libSNP.MISSING] = np.nan
+            if gen.dtype == np.int8: vals = libSNP.toInt8(vals)
+            gen[np.ix_([irow for i,irow in samples[start:start+256]],icols)] = vals
+        # Calls with a third allele in the cached file, the allele may be known here
+        for i,j,call in entry['odd']:
+            mark,sample = entry['markers'][j],entry['samples'][i]
+            if mark not in self.mark or sample not in self.ped: continue
+            a = self.tbase012(call,mark)
+            if a not in ['0','1','2']: gen[self.ped[sample]['rank'],self.mark[mark]['rank']] = self.missing
+            else: gen[self.ped[sample]['rank'],self.mark[mark]['rank']] = int(a)-1
 
     def readPedigree(self,pedfile,count=0,real=True):
         """
@@ -147,30 +192,38 @@ class SNP(object):
         """
         ped = {}
         pedlist = []
-        if pedfile.rsplit('.',1)[1]  == 'gz': op = gzip.open
+        if not real and self.cache:
+            lines = [['0']*self.nc+l for l in self.cacheEntry(pedfile)['pedigree']]
+        else:
+            lines = self.splitLines(pedfile)
+        for l in lines:
+            name,father,mother,family,sex = '0','0','0','0','3'
+            if len(l) > 0: name = l[self.nc]
+            if (real or self.ic > 1) and len(l) > 1: father = l[self.nc+1]
+            if (real or self.ic > 2) and len(l) > 2: mother = l[self.nc+2]
+            if real and len(l) > 4: family,sex = l[3],l[4]
+            if name == '0': continue
+            if name not in ped:
+                ped[name] = {'father':father,
+                             'mother':mother,
+                             'rank':count,
+                             'sex':sex,
+                             'children':[]}
+                count += 1
+                pedlist.append(name)
+            else:
+                sys.stderr.write('%s present more than once\n' % name)
+        self.updatePed(ped)
+        return ped,pedlist
+
+    def splitLines(self,infile):
+        # Yields the split lines of a file, skipping comments
+        if infile.rsplit('.',1)[1]  == 'gz': op = gzip.open
         else: op = open
-        with op(pedfile,'r') as fin:
+        with op(infile,'r') as fin:
             for line in fin:
                 if line.startswith('#'): continue
-                l = line.strip().split()
-                name,father,mother,family,sex = '0','0','0','0','3'
-                if len(l) > 0: name = l[self.nc]
-                if (real or self.ic > 1) and len(l) > 1: father = l[self.nc+1]
-                if (real or self.ic > 2) and len(l) > 2: mother = l[self.nc+2]
-                if real and len(l) > 4: family,sex = l[3],l[4]
-                if name == '0': continue
-                if name not in ped:
-                    ped[name] = {'father':father,
-                                 'mother':mother,
-                                 'rank':count,
-                                 'sex':sex,
-                                 'children':[]}
-                    count += 1
-                    pedlist.append(name)
-                else:
-                    sys.stderr.write('%s present more than once\n' % name)
-        self.updatePed(ped)
-        return ped,pedlist
+                yield line.strip().split()
 
     def collectPedigree(self,pedfile,file1,file2):
         """
@@ -243,17 +296,16 @@ class SNP(object):
         try:
             s1 = self.gen1[self.ped[father]['rank'],:]
             s2 = self.gen[self.ped[anim]['rank'],:]
-            resF = s1-s2
+            ok = libSNP.called(s1) & libSNP.called(s2)
             try:
-                corrF = np.corrcoef(s1[np.isfinite(resF)],s2[np.isfinite(resF)])[0,1]
+                corrF = np.corrcoef(s1[ok],s2[ok])[0,1]
             except IndexError:
                 corrF = np.nan
-            rightF = resF==0
-            sitesF = len(resF) - np.count_nonzero(np.isnan(resF))
+            rightF = (s1 == s2) & ok
+            sitesF = np.count_nonzero(ok)
         except KeyError:
             rightF = [False]*len(self.mark)
             sitesF = 0
-            resF = rightF
             corrF = np.nan
         if sitesF == 0:
             pct = -1
@@ -283,13 +335,13 @@ class SNP(object):
         rc = self.mark[mark]['rank']
         s1 = self.gen1[:,rc]
         s2 = self.gen[:,rc]
-        resF = s1-s2
+        ok = libSNP.called(s1) & libSNP.called(s2)
         try:
-            corrF = np.corrcoef(s1[np.isfinite(resF)],s2[np.isfinite(resF)])[0,1]
+            corrF = np.corrcoef(s1[ok],s2[ok])[0,1]
         except IndexError:
             corrF = np.nan
-        sitesF = len(resF) - np.count_nonzero(np.isnan(resF))
-        rightF = resF==0
+        sitesF = np.count_nonzero(ok)
+        rightF = (s1 == s2) & ok
         if sitesF == 0:
             pct = -1
         else:
@@ -321,14 +373,39 @@ def main():
     parser.add_argument('-m','--markers',help='Marker file',required=True)
     parser.add_argument('-n','--informat',help='Format of input file (Plink/DMU/Geno)',default='Geno')
     parser.add_argument('-c','--chrom',help='Chromosome to work on')
+    parser.add_argument('-s','--store',help='Genotype storage (float/int8), int8 uses 1 byte per genotype',default='float')
+    parser.add_argument('--cache',help='Directory for cached binary copies of the genotype files')
+    parser.add_argument('--rebuild-cache',action="store_true",help='Parse the genotype files again and replace their cache entries')
+    parser.add_argument('--clear-cache',action="store_true",help='Remove the cache entries of the genotype files and run without the cache')
+    parser.add_argument('--profile',help='JSON file with the time and memory used by each stage of the run')
     parser.add_argument('-v','--verbose',action="store_true",help='Prints runtime info')
     args = parser.parse_args()
-    gen = SNP(args.informat,args.verbose)
+    prof = libSNP.Profile(args.profile,'comparegeno')
+    gen = SNP(args.informat,args.verbose,args.store.lower())
+    if args.cache:
+        cache = libSNP.GenoCache(args.cache,args.verbose)
+        if args.clear_cache:
+            for genofile in [args.ingeno,args.reference]:
+                if genofile: cache.clear(genofile)
+        else:
+            gen.cache = cache
+            gen.rebuild = args.rebuild_cache
+    prof.stage('pedigree')
     gen.collectPedigree(args.pedigree,args.ingeno,args.reference)
+    prof.count(animals=len(gen.ped))
+    prof.stage('markers')
     gen.readMarkers(args.markers,args.chrom)
+    prof.count(markers=len(gen.marklist))
+    prof.stage('genotypes')
     gen.readGenos(args.ingeno,args.reference)
-    if args.type: gen.findMark(args.repfile)
-    else: gen.findDup(args.repfile)
+    prof.count(genotypes=(2 if args.reference else 1)*len(gen.ped)*len(gen.marklist))
+    if args.type:
+        prof.stage('markers_compared',markers=len(gen.marklist))
+        gen.findMark(args.repfile)
+    else:
+        prof.stage('animals_compared',animals=len(gen.pedlist))
+        gen.findDup(args.repfile)
+    prof.write()
 
 if __name__ == '__main__':
     main()
@@ -9,10 +9,12 @@ import time
 import libMark
 import libPed
 import libGeno
+import libSNP
 from optparse import OptionParser
 import numpy as np
 import gzip
 import math
+import hashlib
 
 def tbase012(a1,a2,A,B):
 	res = ''
@@ -31,28 +33,106 @@ def tbasenum(a):
 	elif a in 'T4': return '4'
 	return '0'
 
+def discordCounts(gen,rows1,rows2):
+	""" Opposite homozygotes and informative sites of every pair of rows1 x rows2 in gen (0/1/2, nan for missing),
+	    the same counts as taking the difference of the two rows """
+	ind = []
+	for rows in [rows1,rows2]:
+		g = gen[rows]
+		ind.append([(g == 0).astype(np.float32),(g == 2).astype(np.float32),(~np.isnan(g)).astype(np.float32)])
+	(a0,a2,an),(b0,b2,bn) = ind
+	wrong = np.dot(a0,b2.T)+np.dot(a2,b0.T)
+	info = np.dot(an,bn.T)
+	return np.rint(wrong).astype(np.int64),np.rint(info).astype(np.int64)
+
+def pairCounts(cache,gen,rows1,rows2,blocksize):
+	""" Opposite homozygotes and informative sites of the pairs of rows (rows1[k],rows2[k]) in gen,
+	    the pairs not in the libSNP.PairCache are counted and added to it """
+	wrong,info = cache.get(rows1,rows2)
+	new = np.nonzero(wrong < 0)[0]
+	for start in xrange(0,len(new),blocksize):
+		k = new[start:start+blocksize]
+		res = gen[rows2[k]]-gen[rows1[k]]
+		wrong[k] = np.count_nonzero(np.abs(res) == 2,axis=1)
+		info[k] = res.shape[1]-np.count_nonzero(np.isnan(res),axis=1)
+	cache.put(rows1[new],rows2[new],wrong[new],info[new])
+	return wrong,info
+
+def readGenos(genofile,marklist,markers,header):
+	""" Returns the animals in a genotype file and their genotypes coded as 0/1/2, in file order
+	    The genotypes are int8 with libSNP.MISSING for missing, warnings for unknown markers are counted """
+	fin = open(genofile,'r')
+	if header: fin.next()
+	anims,genos,warnings = [],[],0
+	for line in fin:
+		if line.startswith('#'): continue
+		l = line.strip().split()
+		row = np.zeros(len(marklist))
+		icolumn = 0
+		for i in xrange(0,len(marklist)*2,2):
+			a1,a2 = l[i+3:i+5]
+			try: m1,m2 = markers.getMAlleles(marklist[icolumn])
+			except KeyError:
+				if marklist[icolumn] not in markers.getMarkers():
+					print "WARNING! Incomplete markerlist"
+					warnings += 1
+					a1,a2 = '0','0'
+				else:
+					print "ERROR! Failed to assign marker alleles",marklist[icolumn]
+					sys.exit(1)
+			if m1==m2 or '0' in m1+m2: row[icolumn] = 1
+			else: row[icolumn] = tbase012(a1,a2,tbasenum(m1),tbasenum(m2))
+			icolumn += 1
+		anims.append(l[0])
+		genos.append(libSNP.toInt8(row))
+	fin.close()
+	return anims,np.array(genos,dtype=np.int8).reshape(len(genos),len(marklist)),warnings
+
+def loadGenos(options,genofile,marklist,markers,header):
+	""" Same as readGenos, through the binary cache if one is used """
+	if not options.cache: return readGenos(genofile,marklist,markers,header)[:2]
+	cache = libSNP.GenoCache(options.cache,options.verbose)
+	# The coding depends on the marker alleles, which come from the marker file or the first genotype file
+	keys = {'tool':'fastpedcheck','header':header,
+		'genofile':cache.key(options.genofile,{}),
+		'markers':cache.key(options.markers or options.genofile,{})}
+	entry = None
+	if not options.rebuildcache: entry = cache.load(genofile,keys)
+	if entry is None:
+		anims,genos,warnings = readGenos(genofile,marklist,markers,header)
+		entry = {'samples':anims,'genos':genos,'warnings':warnings}
+		cache.save(genofile,keys,entry)
+	else:
+		for i in xrange(entry['warnings']): print "WARNING! Incomplete markerlist"
+	return entry['samples'],entry['genos']
+
 def pedcheck(options):
 	#if options.genotypefile[-3:0] == '.gz': fin = gzip.open(options.genotypefile,'r')
 	#else: fin = open(options.genotypefile,'r')
 	#***** Check requirements and read data *****
+	prof = libSNP.Profile(options.profile,'fastpedcheck')
+	prof.stage('pedigree')
 	if options.pedigree: pedigree = libPed.Ped(options.pedigree)
 	else:
 		print "Gathering pedigree from data"
 		pedigree = libGeno.extractPedigree(options.genofile)
 		#sys.stderr.write('Pedigree file needed.\n')
 		#sys.exit(1)
+	prof.count(animals=len(pedigree))
+	prof.stage('markers')
 	if options.markers: markers = libMark.Mark(options.markers)
 	else:
 		print "Gathering markers from data"
 		markers = libGeno.extractBglMark(options.genofile)
 		#sys.stderr.write('Marker file needed.\n')
 		#sys.exit(1)
+	prof.count(markers=len(markers))
+	prof.stage('genotypes')
 	checkAll,checkOrphans = False,False
 	if ',' in options.pedlims: lim = options.pedlims.split(',')
 	else: lim = (options.pedlims,options.pedlims)
 	oldLim,newLim = float(lim[0]),float(lim[1])
 	r = {}
-	hits = {}
 	count = 0
 	for anim in pedigree.getAnimals():
 		r[anim] = count
@@ -60,111 +140,115 @@ def pedcheck(options):
 	#****** Reading data, converting if needed
 	gen2 = None
 	fout = None
-	if options.reportfile: fout = open(options.reportfile,'w')
-	fin = open(options.genofile,'r')
+	if options.reportfile: fout = libSNP.ReportWriter(options.reportfile,background=options.background)
 	rows = len(pedigree)
 	columns = len(markers)
 	gen = np.zeros((rows,columns))
+	fin = open(options.genofile,'r')
 	marklist = fin.next().strip('#').strip().split()
-	newanims = {}
-	for line in fin:
-		l = line.strip().split()
-		icolumn = 0
-		irow = r[l[0]]
-		newanims[l[0]] = 1
-		for i in xrange(0,len(marklist)*2,2):
-			a1,a2 = l[i+3:i+5]
-			try: m1,m2 = markers.getMAlleles(marklist[icolumn])
-			except KeyError:
-				if marklist[icolumn] not in markers.getMarkers():
-					print "WARNING! Incomplete markerlist"
-					a1,a2 = '0','0'
-				else:
-					print "ERROR! Failed to assign marker alleles",marklist[icolumn]
-					sys.exit(1)
-			if m1==m2 or '0' in m1+m2: gen[irow,icolumn] = 1
-			else: gen[irow,icolumn] = tbase012(a1,a2,tbasenum(m1),tbasenum(m2))
-			icolumn += 1
 	fin.close()
+	newanims = {}
+	anims,genos = loadGenos(options,options.genofile,marklist,markers,True)
+	for i,anim in enumerate(anims):
+		gen[r[anim],:len(marklist)] = libSNP.fromInt8(genos[i])
+		newanims[anim] = 1
 	if options.genofile2:
-		fin = open(options.genofile2,'r')
-		for line in fin:
-			if line.startswith('#'): continue
-			l = line.strip().split()
-			irow = r[l[0]]
-			icolumn = 0
-			for i in xrange(0,len(marklist)*2,2):
-				a1,a2 = l[i+3:i+5]
-				try: m1,m2 = markers.getMAlleles(marklist[icolumn])
-				except KeyError:
-					if marklist[icolumn] not in markers.getMarkers():
-						print "WARNING! Incomplete markerlist"
-						a1,a2 = '0','0'
-					else:
-						print "ERROR! Failed to assign marker alleles"
-						sys.exit(1)
-				if m1 == m2 or '0' in m1+m2: gen[irow,icolumn] = 1
-				else: gen[irow,icolumn] = tbase012(a1,a2,tbasenum(m1),tbasenum(m2))
-				icolumn += 1
-			irow += 1
-		fin.close()
-	out = ''
+		anims,genos = loadGenos(options,options.genofile2,marklist,markers,False)
+		for i,anim in enumerate(anims): gen[r[anim],:len(marklist)] = libSNP.fromInt8(genos[i])
+	prof.count(genotypes=rows*columns)
+	prof.stage('parents')
 	sep = '\t'
+	out = None
+	if options.reportped: out = libSNP.ReportWriter(options.reportped,'#ID\tparent\tdiscords\tinfo_sites\tdiscord%\tparent_sex\n',lazy=True,background=options.background)
 	if fout: fout.write('#ID\tparent\tdiscords\tinfo_sites\tdiscord%\tcategory_sex\n')
-	for anim in pedigree.getAnimals():
+	# Recorded parents, the animals with a mismatch are searched afterwards
+	animals = pedigree.getAnimals()
+	cache = libSNP.PairCache(len(animals),options.maxpairs,options.verbose)
+	if options.paircache:
+		digests = [hashlib.sha1(gen[i].tobytes()).hexdigest() for i in xrange(len(animals))]
+		cache.load(options.paircache,animals,digests)
+	tested = [] # (animal,parent,sex of the parent) of every recorded parent with genotypes
+	for anim in animals:
 		if anim not in newanims: continue
-		mismatch = False
 		sire,dam = pedigree.getSire(anim),pedigree.getDam(anim)
-		if sire != '0' and sire in r and not checkAll:
-			res = gen[r[sire],:]-gen[r[anim],:]
-			wrong = len(res[res==2]) + len(res[res==-2])
-			identical = len(res[res==0])
-			info = len(res)-len(res[np.isnan(res)])
-			if info == 0: out += anim+sep+sire+sep+str(wrong)+sep+str(info)+sep+'-1'+sep+'1'+'\n'
-			else: out += anim+sep+sire+sep+str(wrong)+sep+str(info)+sep+str(wrong*100.0/info)+sep+'1'+'\n'
-			if info == 0: pass
-			elif wrong*100.0/info > oldLim: 
-				mismatch = True
-				if fout: fout.write('%s\t%s\t%d\t%d\t%.3f\t%s\n' % (anim,sire,wrong,info,wrong*100.0/info,'W1'))
-			hits[anim,sire] = wrong,info
-		if dam != '0' and dam in r and not checkAll:
-			res = gen[r[dam],:]-gen[r[anim],:]
-			wrong = len(res[res==2]) + len(res[res==-2])
-			identical = len(res[res==0])
-			info = len(res)-len(res[np.isnan(res)])
-			if info == 0: out += anim+sep+dam+sep+str(wrong)+sep+str(info)+sep+'-1'+sep+'0'+'\n'
-			else: out += anim+sep+dam+sep+str(wrong)+sep+str(info)+sep+str(wrong*100.0/info)+sep+'0'+'\n'
+		if sire != '0' and sire in r and not checkAll: tested.append((anim,sire,'1'))
+		if dam != '0' and dam in r and not checkAll: tested.append((anim,dam,'0'))
+	rows1 = np.array([r[anim] for anim,parent,psex in tested],dtype=int)
+	rows2 = np.array([r[parent] for anim,parent,psex in tested],dtype=int)
+	pwrong,pinfo = pairCounts(cache,gen,rows1,rows2,options.blocksize)
+	report = [] # (animal,lines for its recorded parents,searched) of the animals with lines in the report
+	mismatched = []
+	involved = {} # Pairs tested by the recorded parents, as (position,other animal) for both animals
+	k = 0
+	for anim in animals:
+		if anim not in newanims: continue
+		mismatch = False
+		lines = ''
+		while k < len(tested) and tested[k][0] == anim:
+			parent,psex = tested[k][1:]
+			wrong,info = int(pwrong[k]),int(pinfo[k])
+			k += 1
+			if out:
+				if info == 0: out.write(anim+sep+parent+sep+str(wrong)+sep+str(info)+sep+'-1'+sep+psex+'\n')
+				else: out.write(anim+sep+parent+sep+str(wrong)+sep+str(info)+sep+str(wrong*100.0/info)+sep+psex+'\n')
 			if info == 0: pass
 			elif wrong*100.0/info > oldLim:
 				mismatch = True
-				if fout: fout.write('%s\t%s\t%d\t%d\t%.3f\t%s\n' % (anim,dam,wrong,info,wrong*100.0/info,'W0'))
-			hits[anim,dam] = wrong,info
+				lines += '%s\t%s\t%d\t%d\t%.3f\t%s\n' % (anim,parent,wrong,info,wrong*100.0/info,'W'+psex)
+			involved.setdefault(anim,[]).append((r[anim],parent))
+			involved.setdefault(parent,[]).append((r[anim],anim))
+		sire,dam = pedigree.getSire(anim),pedigree.getDam(anim)
 		if sire == '0' and dam == '0' and len(pedigree.getOffspring(anim)) == 0: mismatch = True
-		if mismatch: # Search for better matches
-			for anim2 in pedigree.getAnimals():
-				if anim2 == anim: continue
-				sex = pedigree.getSex(anim2)
-				if (anim,anim2) in hits:
-					wrong,info = hits[anim,anim2]
-					rep = True
-				elif (anim2,anim) in hits: 
-					wrong,info = hits[anim2,anim]
-					rep = True
-				else:
-					res = gen[r[anim2],:]-gen[r[anim],:]
-					wrong = len(res[res==2]) + len(res[res==-2])
-					identical = len(res[res==0])
-					info = len(res)-len(res[np.isnan(res)])
-					rep = False
-					hits[anim,anim2] = wrong,info
-				if info == 0 or rep: pass
-				elif wrong*100.0/info <= newLim:
-					if fout: fout.write('%s\t%s\t%d\t%d\t%.3f\t%s\n' % (anim,anim2,wrong,info,wrong*100.0/info,'N'+sex))
+		if mismatch: mismatched.append(anim)
+		if lines or mismatch: report.append((anim,lines,mismatch))
+	if out: out.close()
+	# Search for better matches, blocks of mismatched animals against all animals
+	# A pair tested before an animal is searched is not reported: its recorded parents and the
+	# animals with it as a recorded parent checked before it, and the animals searched before it
+	sexes = ['N'+pedigree.getSex(anim2) for anim2 in animals]
+	searched = np.zeros(len(animals),dtype=bool)
+	found = {} # Searched animals not yet written to the report
+	nwritten = 0
+	nsearch = 0
+	for start in xrange(0,len(mismatched),options.blocksize):
+		block = mismatched[start:start+options.blocksize]
+		rows1 = np.array([r[anim] for anim in block],dtype=int)
+		wrong = np.zeros((len(block),len(animals)),dtype=np.int64)-1
+		info = np.zeros((len(block),len(animals)),dtype=np.int64)
+		if options.paircache:
+			# Only stored between runs, the pairs of a search are not tested again in the same run
+			w,n = cache.get(np.repeat(rows1,len(animals)),np.tile(np.arange(len(animals)),len(block)))
+			wrong[:],info[:] = w.reshape(wrong.shape),n.reshape(info.shape)
+			wrong[np.arange(len(block)),rows1] = 0
+		if (wrong < 0).any():
+			for k in xrange(0,len(animals),options.blocksize):
+				wrong[:,k:k+options.blocksize],info[:,k:k+options.blocksize] = discordCounts(gen,rows1,np.arange(k,min(k+options.blocksize,len(animals))))
+			if options.paircache: cache.put(np.repeat(rows1,len(animals)),np.tile(np.arange(len(animals)),len(block)),wrong,info)
+		for i,anim in enumerate(block):
+			skip = searched.copy()
+			skip[r[anim]] = True
+			for pos,anim2 in involved.get(anim,[]):
+				if pos <= r[anim]: skip[r[anim2]] = True
+			nsearch += len(animals)-np.count_nonzero(skip)
+			searched[r[anim]] = True
+			lines = ''
+			for j in np.nonzero(~skip & (info[i] > 0))[0]:
+				w,n = int(wrong[i,j]),int(info[i,j])
+				if w*100.0/n <= newLim: lines += '%s\t%s\t%d\t%d\t%.3f\t%s\n' % (anim,animals[j],w,n,w*100.0/n,sexes[j])
+			found[anim] = lines
+		# The report up to the last animal of the block
+		while len(found):
+			anim,lines,mismatch = report[nwritten]
+			nwritten += 1
+			if mismatch: lines += found.pop(anim)
+			if fout: fout.write(lines)
+	if fout:
+		for anim,lines,mismatch in report[nwritten:]: fout.write(lines)
+	prof.count(pairs=len(set((anim,parent) for anim,parent,psex in tested))+nsearch,stored=len(cache))
+	if options.paircache: cache.save(options.paircache,animals,digests)
+	prof.stage('report')
 	if fout: fout.close()
-	if len(out) > 0 and options.reportped:
-		fout = open(options.reportped,'w')
-		fout.write('#ID\tparent\tdiscords\tinfo_sites\tdiscord%\tparent_sex\n'+out)
-		fout.close()
+	prof.write()
 
 def main():
 	usage = """usage: %prog [options]"""
@@ -176,8 +260,16 @@ def main():
 	parser.add_option("-p",dest="pedigree",help="Pedigree", metavar="FILE")
 	parser.add_option("-m",dest="markers",help="Markers", metavar="FILE")
 	parser.add_option("-a",dest="pedlims",help="Limits for pedcheck", metavar="N[,N]",default='5')
+	parser.add_option("-b",dest="blocksize",type="int",help="animals per block in the search for parents",default=256)
+	parser.add_option("--pair-cache",dest="paircache",help="file keeping the counts of tested pairs between runs, pairs of unchanged animals are not counted again", metavar="FILE")
+	parser.add_option("--max-pairs",dest="maxpairs",type="int",help="most pairs kept in memory by the pair cache, the oldest are dropped, 0 for no bound",default=libSNP.PairCache.MAXPAIRS)
+	parser.add_option("--background-writer",dest="background",action="store_true",help="writes the reports from a thread of their own while the search runs",default=False)
 	parser.add_option("-v",dest="verbose",action="store_true",help="prints runtime info",default=False)
 	parser.add_option("-w",dest="nowarning",action="store_true",help="does not stop at missing markers/animals",default=False)
+	parser.add_option("--cache",dest="cache",help="directory for cached binary copies of the genotype files", metavar="DIR")
+	parser.add_option("--rebuild-cache",dest="rebuildcache",action="store_true",help="parses the genotype files again and replaces their cache entries",default=False)
+	parser.add_option("--clear-cache",dest="clearcache",action="store_true",help="removes the cache entries of the genotype files and runs without the cache",default=False)
+	parser.add_option("--profile",dest="profile",help="JSON file with the time and memory used by each stage of the run", metavar="FILE")
 	parser.add_option("-G",dest="galaxy",action="store_true",help="Script is being run from galaxy",default=False)
 	(options,args) = parser.parse_args()
 	t = time.time()
@@ -196,6 +288,11 @@ def main():
 	if options.genofile2 and not options.pedigree:
 		parser.error('ERROR: Pedigree required when using second genotype file.')
 		sys.exit(1)
+	if options.cache and options.clearcache:
+		cache = libSNP.GenoCache(options.cache,options.verbose)
+		for genofile in [options.genofile,options.genofile2]:
+			if genofile: cache.clear(genofile)
+		options.cache = None
 	pedcheck(options)
 	print "Time pedcheck: %.3f" % (time.time()-t)
         
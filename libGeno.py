@@ -1170,6 +1170,13 @@ def writeBglMark(mark, fout):
         count += 1
 
 def main():
+    # --profile FILE can be given anywhere, it writes the time and memory used by each stage as JSON
+    prof = None
+    if '--profile' in sys.argv[:-1]:
+        i = sys.argv.index('--profile')
+        import libSNP
+        prof = libSNP.Profile(sys.argv[i+1],'libGeno')
+        del sys.argv[i:i+2]
     try:
         fin = open(sys.argv[1],'r')
         opt = sys.argv[2]
@@ -1180,7 +1187,11 @@ def main():
     except:
         print """ ped/mark/switch/stat/del#/bglmark/adist\n"""
         sys.exit(0)
-    if opt not in ['ped','mark','bglmark']: cr = Geno(sys.argv[1],'0','0')
+    if prof: prof.stage('read')
+    if opt not in ['ped','mark','bglmark']:
+        cr = Geno(sys.argv[1],'0','0')
+        if prof: prof.count(animals=len(cr.genotypes),markers=len(cr.mark))
+    if prof: prof.stage(opt)
     if opt == 'ped': fout.write(str(extractPedigree(sys.argv[1])))
     elif opt == 'mark': fout.write(str(extractMarkers(sys.argv[1])))
     elif opt == 'bglmark':
@@ -1208,6 +1219,7 @@ def main():
     else: print "Illegal option"
     fin.close()
     fout.close()
+    if prof: prof.write()
     
 class EmptyGeno(object):
     def __init__(self):
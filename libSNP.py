@@ -0,0 +1,812 @@
+#!/usr/bin/env python
+
+# Shared genotype parsing and caching for pedcheck.py, comparegeno.py and fastpedcheck.py
+
+# Description:
+# Genotype lines are translated into -1/0/1 codes through byte arrays, one line at a time.
+# A parsed genotype file can be stored as a memory-mappable binary cache, keyed on the
+# path, size and modification time of the file and on the options used to read it.
+# Binary PLINK filesets (.bed/.bim/.fam) are memory-mapped and decoded a block of markers at a time.
+# Text inputs may be gzip'ed, the passes over every input and the bytes read are counted.
+# Profile records the time and memory used by each stage of a run (the --profile option of the tools).
+
+from __future__ import division, print_function
+import os
+import sys
+import json
+import shutil
+import zipfile
+import gzip
+import io
+import locale
+import atexit
+import threading
+try: import Queue
+except ImportError: import queue as Queue
+import hashlib
+import time
+import numpy as np
+try: import resource
+except ImportError: resource = None # Peak memory is not reported where the module is missing
+
+MISSING = -9 # int8 code for a missing genotype
+
+# Translation from the characters 0/1/2 to -1/0/1, anything else is missing
+TABLE012 = np.zeros(256)
+TABLE012[:] = np.nan
+TABLE012[[ord('0'),ord('1'),ord('2')]] = [-1,0,1]
+
+READS = {} # (passes,bytes) read from every input file, added to by InputFile
+
+class InputFile(object):
+    """
+        A text file opened for reading, gzip'ed if the name ends with .gz
+        Iterates over the lines. When the file is closed, the pass and the bytes read
+        from disk (the compressed bytes of a .gz file) are added to READS.
+    """
+    def __init__(self,infile):
+        self.name = infile
+        self.raw = open(infile,'rb')
+        stream = gzip.GzipFile(fileobj=self.raw) if infile.endswith('.gz') else self.raw
+        if sys.version_info[0] > 2: self.fin = io.TextIOWrapper(stream)
+        else: self.fin = stream
+
+    def __iter__(self):
+        return iter(self.fin)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def close(self):
+        if self.raw.closed: return
+        addRead(self.name,self.raw.tell())
+        self.fin.close()
+        self.raw.close()
+
+def addRead(infile,nbytes):
+    # Counts one pass over an input file
+    passes,total = READS.get(infile,(0,0))
+    READS[infile] = (passes+1,total+nbytes)
+
+def openFile(infile):
+    """ Opens a text file for reading, gzip'ed if the name ends with .gz """
+    return InputFile(infile)
+
+def textSize(infile):
+    """
+        Returns the bytes of text in a file, for a .gz file the size stored at its end
+        (modulo 4 GB, and of the last member only if there are several)
+    """
+    if not infile.endswith('.gz'): return os.path.getsize(infile)
+    with open(infile,'rb') as fin:
+        fin.seek(-4,2)
+        return int(np.frombuffer(fin.read(4),dtype='<u4')[0])
+
+def bytesRead():
+    """ Returns the bytes read from all input files """
+    return sum(nbytes for passes,nbytes in READS.values())
+
+def reportReads(out=None):
+    # Writes the passes over every input file and the bytes read, against the size of the file
+    out = out or sys.stderr
+    for name in sorted(READS):
+        passes,nbytes = READS[name]
+        out.write('Read %s: %d pass%s, %d of %d bytes\n' % (name,passes,'' if passes == 1 else 'es',nbytes,os.path.getsize(name)))
+
+def newAlleles(nmark):
+    """ Returns an empty allele state: first allele, second allele and number of alleles per marker """
+    return [np.zeros(nmark,dtype=np.int32),np.zeros(nmark,dtype=np.int32),np.zeros(nmark,dtype=np.int32)]
+
+def codeAlleles(x,y,icols,alleles,marklist,odd=None):
+    """
+        Vectorized version of tbase012 in pedcheck.py
+        x and y are the character codes of the two alleles of each call, icols the markers
+        they belong to. alleles is the allele state from newAlleles and is updated with
+        the alleles that have not been seen before.
+        Calls with a third allele are reported, or appended to odd as (index,call) if given
+        Returns the calls coded as -1/0/1, nan for missing
+    """
+    zero = ord('0')
+    m1,m2,n = alleles[0][icols],alleles[1][icols],alleles[2][icols]
+    # First allele(s) of a marker
+    het = x != y
+    new = (n == 0) & het
+    m1,m2,n = np.where(new,x,m1),np.where(new,y,m2),np.where(new,2,n)
+    new = (n == 0) & (x != zero)
+    m1,n = np.where(new,x,m1),np.where(new,1,n)
+    # Second allele of a marker
+    newx = (n == 1) & (x != zero) & (x != m1)
+    newy = (n == 1) & ~newx & (y != zero) & (y != m1)
+    m2 = np.where(newx,x,np.where(newy,y,m2))
+    n = np.where(newx | newy,2,n)
+    alleles[0][icols],alleles[1][icols],alleles[2][icols] = m1,m2,n
+    res = np.empty(len(x))
+    res[:] = np.nan
+    hom1 = ~het & (n > 0) & (x == m1)
+    hom2 = ~het & ~hom1 & (n > 1) & (x == m2)
+    res[het] = 0
+    res[hom1] = -1
+    res[hom2] = 1
+    for i in np.nonzero(~het & ~hom1 & ~hom2 & (x != zero))[0]:
+        if odd is not None:
+            odd.append((i,chr(x[i])+chr(y[i])))
+            continue
+        sys.stderr.write('ERROR: Marker %s has more than 2 alleles: [%s]\n' % (marklist[icols[i]],chr(x[i])+chr(y[i])))
+    return res
+
+def parseGenos(l,ic,ia,nmark,pos,icols,alleles,marklist,odd=None):
+    """
+        Converts the genotypes of one split line into -1/0/1 (nan for missing)
+        ic and ia are the information columns and allele format, as in pedcheck.SNP
+        pos are the positions in the header of the markers to keep, icols their ranks
+        All calls are translated at once through byte arrays, falling back to
+        one call at a time only when the alleles are not single characters.
+    """
+    if ia == 1:
+        genos = l[ic:ic+nmark]
+        text = ''.join(genos)
+        if len(text) == nmark:
+            try: return TABLE012[np.frombuffer(text.encode('latin-1'),dtype=np.uint8)[pos]]
+            except UnicodeError: pass
+        return np.array([int(genos[i])-1 if genos[i] in ['0','1','2'] else np.nan for i in pos])
+    genos = l[ic:ic+nmark*(ia-1)]
+    text = ''.join(genos)
+    codes = None
+    if len(text) == 2*nmark:
+        try: codes = np.frombuffer(text.encode('latin-1'),dtype=np.uint8).reshape(nmark,2)[pos].astype(np.int32)
+        except UnicodeError: pass
+    if codes is None:
+        codes = np.zeros((len(pos),2),dtype=np.int32)
+        for j,i in enumerate(pos):
+            if ia == 2: a = genos[i]
+            else: a = genos[i*2]+genos[i*2+1]
+            if len(a) == 1: a = a+a
+            codes[j] = ord(a[0]),ord(a[1])
+    return codeAlleles(codes[:,0],codes[:,1],icols,alleles,marklist,odd)
+
+def toInt8(genos):
+    """ Converts -1/0/1 codes with nan for missing into int8 codes with MISSING for missing """
+    res = np.zeros(genos.shape,dtype=np.int8)
+    res[:] = MISSING
+    called = ~np.isnan(genos)
+    res[called] = genos[called]
+    return res
+
+def fromInt8(genos):
+    """ Reverses toInt8 """
+    res = genos.astype(np.float64)
+    res[genos == MISSING] = np.nan
+    return res
+
+def called(genos):
+    """ Returns where calls are present, in float (nan for missing) or int8 (MISSING) genotypes """
+    if genos.dtype == np.int8: return genos != MISSING
+    return ~np.isnan(genos)
+
+def readGenoFile(infile,ic,ia,nc):
+    """
+        Parses a whole genotype file, independent of any pedigree or marker file
+        Returns a dict with
+          samples:  sample names in the order they are first seen
+          pedigree: name, father and mother of every genotype line, as read by pedcheck.SNP.readPedigree
+          markers:  marker names in the order they are first seen in the header(s)
+          genos:    int8 matrix (samples,markers) with -1/0/1 codes and MISSING for missing calls
+          alleles:  the alleles found for each marker, as strings
+          odd:      [sample,marker,call] for the calls with a third allele, these are missing in
+                    genos and have to be recoded by the reader, as the allele can be known there
+        A later line for the same sample overwrites the markers it lists, as in pedcheck.py
+    """
+    samples,pedigree,markers = [],[],[]
+    rows,mrank,odd = {},{},{}
+    alleles = newAlleles(0)
+    with openFile(infile) as fin:
+        for line in fin:
+            if line.startswith('#'):
+                mlist = line.strip('#').strip().split()
+                for mark in mlist:
+                    if mark in mrank: continue
+                    mrank[mark] = len(markers)
+                    markers.append(mark)
+                extra = len(markers)-len(alleles[0])
+                alleles = [np.concatenate([a,np.zeros(extra,dtype=np.int32)]) for a in alleles]
+                pos = np.arange(len(mlist))
+                icols = np.array([mrank[mark] for mark in mlist],dtype=int)
+                continue
+            l = line.strip().split()
+            if len(l) < 1: continue
+            father = mother = '0'
+            if ic > 1 and len(l) > 1: father = l[nc+1]
+            if ic > 2 and len(l) > 2: mother = l[nc+2]
+            pedigree.append([l[nc],father,mother])
+            if l[nc] not in rows:
+                rows[l[nc]] = np.zeros(len(markers))
+                rows[l[nc]][:] = np.nan
+                samples.append(l[nc])
+            elif odd:
+                # Odd calls replaced by this line
+                isample,mset = samples.index(l[nc]),set(icols)
+                for key in [key for key in odd if key[0] == isample and key[1] in mset]: del odd[key]
+            row = rows[l[nc]]
+            if len(row) < len(markers):
+                row = rows[l[nc]] = np.concatenate([row,np.nan*np.zeros(len(markers)-len(row))])
+            calls = []
+            row[icols] = parseGenos(l,ic,ia,len(mlist),pos,icols,alleles,markers,calls)
+            for i,call in calls: odd[(samples.index(l[nc]),int(icols[i]))] = call
+    genos = np.zeros((len(samples),len(markers)),dtype=np.int8)
+    genos[:] = MISSING
+    for i,sample in enumerate(samples):
+        genos[i,:len(rows[sample])] = toInt8(rows[sample])
+    found = []
+    for i in range(len(markers)):
+        found.append(''.join([chr(alleles[0][i]),chr(alleles[1][i])][:alleles[2][i]]))
+    odd = [[i,j,odd[(i,j)]] for i,j in sorted(odd)]
+    return {'samples':samples,'pedigree':pedigree,'markers':markers,'genos':genos,'alleles':found,'odd':odd}
+
+# Genotypes of 4 samples in every byte of a PLINK .bed file, as 2-bit codes read from the lowest bits
+BED2BIT = np.array([[(b >> 2*k) & 3 for k in range(4)] for b in range(256)],dtype=np.uint8)
+BED_HOM1,BED_MISSING,BED_HET,BED_HOM2 = 0,1,2,3
+
+def isPlink(infile):
+    """ True if the file is the .bed file of a binary PLINK fileset """
+    return infile.endswith('.bed')
+
+def readFam(bedfile):
+    """ Returns the lines of the .fam file belonging to a .bed file, split into columns """
+    with open(bedfile[:-4]+'.fam','r') as fin:
+        return [l for l in (line.strip().split() for line in fin) if len(l) > 0]
+
+def readBim(bedfile):
+    """ Returns the lines of the .bim file belonging to a .bed file, split into columns """
+    with open(bedfile[:-4]+'.bim','r') as fin:
+        return [l for l in (line.strip().split() for line in fin) if len(l) > 0]
+
+class BedFile(object):
+    """
+        Memory-mapped SNP-major PLINK .bed file
+        Every marker is stored as (nsamples+3)//4 bytes, 2 bits per sample:
+        00 = hom A1, 01 = missing, 10 = het, 11 = hom A2 (A1/A2 as in the .bim file)
+    """
+
+    def __init__(self,bedfile,nsamples,nmarkers):
+        self.nsamples = nsamples
+        self.nmarkers = nmarkers
+        self.rowbytes = (nsamples+3)//4
+        with open(bedfile,'rb') as fin: magic = bytearray(fin.read(3))
+        if len(magic) < 3 or magic[0] != 0x6c or magic[1] != 0x1b:
+            sys.stderr.write('ERROR: %s is not a PLINK .bed file\n' % bedfile)
+            sys.exit(1)
+        if magic[2] != 1:
+            sys.stderr.write('ERROR: %s is sample-major, only SNP-major .bed files are supported\n' % bedfile)
+            sys.exit(1)
+        if os.path.getsize(bedfile) != 3+nmarkers*self.rowbytes:
+            sys.stderr.write('ERROR: Size of %s does not match %d samples and %d markers\n' % (bedfile,nsamples,nmarkers))
+            sys.exit(1)
+        self.bed = np.memmap(bedfile,dtype=np.uint8,mode='r',offset=3,shape=(nmarkers,self.rowbytes))
+
+    def codes(self,pos):
+        """ Returns the 2-bit codes of the markers at positions pos as a (samples,markers) matrix """
+        block = BED2BIT[self.bed[pos]].reshape(len(pos),self.rowbytes*4)
+        return block[:,:self.nsamples].T
+
+class GenoCache(object):
+    """
+        Binary cache of parsed genotype files
+        Every entry is a directory holding the genotype matrix as a .npy file, which is
+        memory-mapped when loaded, and a JSON file with the rest of the information.
+        Entries are keyed on the absolute path, size and modification time of the input
+        file and on the options used to read it, so a changed file gets a new entry.
+    """
+
+    def __init__(self,cachedir,verbose=False):
+        self.cachedir = cachedir
+        self.verbose = verbose
+        if not os.path.isdir(cachedir): os.makedirs(cachedir)
+
+    def key(self,infile,options):
+        # Unique key for the input file and options
+        st = os.stat(infile)
+        mtime = getattr(st,'st_mtime_ns',None)
+        if mtime is None: mtime = st.st_mtime
+        desc = json.dumps([os.path.abspath(infile),st.st_size,mtime,sorted(options.items())])
+        return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+    def path(self,infile,options):
+        return os.path.join(self.cachedir,'%s.%s' % (os.path.basename(infile),self.key(infile,options)[:16]))
+
+    def load(self,infile,options):
+        """ Returns the cached entry as a dict, with the matrix memory-mapped, or None if there is none """
+        path = self.path(infile,options)
+        try:
+            with open(os.path.join(path,'info.json'),'r') as fin: entry = json.load(fin)
+            entry['genos'] = np.load(os.path.join(path,'genos.npy'),mmap_mode='r')
+        except (IOError,OSError,ValueError):
+            return None
+        if self.verbose: sys.stdout.write('Using cached genotypes for %s\n' % infile)
+        return entry
+
+    def save(self,infile,options,entry):
+        """ Stores an entry, the 'genos' item is written as a binary matrix """
+        path = self.path(infile,options)
+        if os.path.isdir(path): shutil.rmtree(path)
+        tmp = path+'.tmp%d' % os.getpid()
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp,'genos.npy'),entry['genos'])
+        info = dict((k,v) for k,v in entry.items() if k != 'genos')
+        info['source'] = os.path.abspath(infile)
+        with open(os.path.join(tmp,'info.json'),'w') as fout: json.dump(info,fout)
+        os.rename(tmp,path)
+        if self.verbose: sys.stdout.write('Cached genotypes for %s in %s\n' % (infile,path))
+
+    def clear(self,infile):
+        """ Removes every cached entry for the input file, whatever options or version it was made with """
+        prefix = os.path.basename(infile)+'.'
+        for name in os.listdir(self.cachedir):
+            if not name.startswith(prefix) or len(name) != len(prefix)+16: continue
+            try:
+                with open(os.path.join(self.cachedir,name,'info.json'),'r') as fin: source = json.load(fin)['source']
+            except (IOError,OSError,ValueError,KeyError):
+                source = None
+            if source in [None,os.path.abspath(infile)]:
+                shutil.rmtree(os.path.join(self.cachedir,name))
+                if self.verbose: sys.stdout.write('Removed cached genotypes %s\n' % name)
+
+class RowIndex(object):
+    """
+        Byte offsets of the lines of a text genotype file, so that the lines of single samples
+        can be read without reading the rest of the file
+        The index is kept in a sidecar file (the genotype file name with .idx added, an uncompressed
+        .npz) and is built again when the size or modification time of the genotype file has changed.
+        headers: [offset,length] of every marker header line
+        offsets, lengths: of every genotype line in file order
+        rowheader: position in headers of the header line each genotype line follows
+        names:   the sample name of every genotype line, as bytes
+        The fathers and mothers of the lines (the columns after the name, as read by
+        pedcheck.SNP.readPedigree) are only read from the sidecar when asked for.
+        gzip'ed files can not be indexed.
+    """
+
+    def __init__(self,infile,nc=0,verbose=False):
+        self.infile = infile
+        self.nc = nc
+        self.verbose = verbose
+        self.sidecar = infile+'.idx'
+        self.mlists = {} # Marker names of the header lines read
+        self.parents = None
+        st = os.stat(infile)
+        mtime = getattr(st,'st_mtime_ns',None)
+        if mtime is None: mtime = int(st.st_mtime*1e9)
+        self.key = np.array([st.st_size,mtime,nc],dtype=np.int64)
+        if not self.load(): self.build()
+
+    def load(self):
+        # Reads the sidecar, False if it is missing or made for another version of the file
+        try:
+            with np.load(self.sidecar,allow_pickle=False) as data:
+                if not np.array_equal(data['key'],self.key): return False
+                self.headers,self.offsets,self.lengths = data['headers'],data['offsets'],data['lengths']
+                self.rowheader,self.names = data['rowheader'],data['names']
+        except (IOError,OSError,ValueError,KeyError,zipfile.BadZipfile):
+            return False
+        if self.verbose: sys.stdout.write('Using row index %s\n' % self.sidecar)
+        return True
+
+    def build(self):
+        # One pass over the genotype file, then the sidecar is written if the directory allows it
+        headers,offsets,lengths,rowheader,names,parents = [],[],[],[],[],[]
+        offset = 0
+        with open(self.infile,'rb') as fin:
+            for line in fin:
+                if line.startswith(b'#'): headers.append([offset,len(line)])
+                else:
+                    fields = line.split(None,self.nc+3)[self.nc:self.nc+3]
+                    if fields:
+                        offsets.append(offset)
+                        lengths.append(len(line))
+                        rowheader.append(len(headers)-1)
+                        fields += [b'0']*(3-len(fields))
+                        names.append(fields[0])
+                        parents.append(fields[1:])
+                offset += len(line)
+        addRead(self.infile,offset)
+        self.headers = np.array(headers,dtype=np.int64).reshape(-1,2)
+        self.offsets,self.lengths = np.array(offsets,dtype=np.int64),np.array(lengths,dtype=np.int64)
+        self.rowheader = np.array(rowheader,dtype=np.int64)
+        self.names = np.array(names,dtype=bytes)
+        self.parents = np.array(parents,dtype=bytes).reshape(-1,2)
+        tmp = self.sidecar+'.tmp%d' % os.getpid()
+        try:
+            with open(tmp,'wb') as fout:
+                np.savez(fout,key=self.key,headers=self.headers,offsets=self.offsets,lengths=self.lengths,
+                         rowheader=self.rowheader,names=self.names,parents=self.parents)
+            os.rename(tmp,self.sidecar)
+        except (IOError,OSError) as e:
+            sys.stderr.write('WARNING: Could not write the row index %s: %s\n' % (self.sidecar,e))
+            return
+        if self.verbose: sys.stdout.write('Indexed %d lines of %s in %s\n' % (len(self.names),self.infile,self.sidecar))
+
+    def find(self,names):
+        """ Returns the positions of the lines of the given samples, in file order """
+        wanted = np.array([encode(name) for name in names],dtype=bytes)
+        return np.nonzero(np.isin(self.names,wanted))[0]
+
+    def samples(self,rows):
+        """ Returns the sample names of the given lines """
+        return [decode(self.names[i]) for i in rows]
+
+    def pedigree(self,rows):
+        """ Returns [name,father,mother] of the given lines """
+        if self.parents is None:
+            with np.load(self.sidecar,allow_pickle=False) as data: self.parents = data['parents']
+        return [[decode(self.names[i]),decode(self.parents[i,0]),decode(self.parents[i,1])] for i in rows]
+
+    def lines(self,rows):
+        """ Yields (row,line) for the given positions in rows, reading only those lines, in file order """
+        nbytes = 0
+        with open(self.infile,'rb') as fin:
+            for i in sorted(rows,key=lambda i: self.offsets[i]):
+                fin.seek(self.offsets[i])
+                nbytes += self.lengths[i]
+                yield i,decode(fin.read(self.lengths[i]))
+        addRead(self.infile,nbytes)
+
+    def header(self,h):
+        """ Returns the marker names of a header line """
+        if h in self.mlists: return self.mlists[h]
+        offset,length = self.headers[h]
+        with open(self.infile,'rb') as fin:
+            fin.seek(offset)
+            self.mlists[h] = decode(fin.read(length)).strip('#').strip().split()
+        addRead(self.infile,length)
+        return self.mlists[h]
+
+def decode(data):
+    # Text of bytes read from a file, str is bytes in python 2
+    if sys.version_info[0] > 2: return data.decode(locale.getpreferredencoding(False))
+    return data
+
+def encode(text):
+    # Bytes of text as found in a file, the reverse of decode
+    if sys.version_info[0] > 2: return text.encode(locale.getpreferredencoding(False))
+    return text
+
+class ResultStore(object):
+    """
+        Persistent pair counts of a parent search, for incremental runs
+        A single .npz file holding the names and row digests of the samples and parents,
+        the marker signature, the noise level used and the pairs within it with their
+        discords and informative sites
+    """
+
+    def __init__(self,path,verbose=False):
+        self.path = path
+        self.verbose = verbose
+
+    def load(self):
+        """ Returns the stored results as a dict, or None if there are none """
+        try:
+            with np.load(self.path) as data: res = dict((k,data[k]) for k in data.files)
+        except (IOError,OSError,ValueError):
+            return None
+        res['markers'] = str(res['markers'])
+        res['limit'] = float(res['limit'])
+        if self.verbose: sys.stdout.write('Using stored results in %s\n' % self.path)
+        return res
+
+    def save(self,res):
+        """ Stores the results, replacing the file only when it is completely written """
+        tmp = self.path+'.tmp%d' % os.getpid()
+        with open(tmp,'wb') as fout: np.savez(fout,**res)
+        os.rename(tmp,self.path)
+        if self.verbose: sys.stdout.write('Stored results in %s\n' % self.path)
+
+class PairCache(object):
+    """
+        Discords and informative sites of pairs of samples, the same for both orders of a pair
+        Samples are numbered from 0 to n-1 and a pair is keyed on its position in the lower triangle
+        of the n x n pair matrix. When all pairs fit (at most DENSE, and in no more memory than a full
+        table of maxpairs) the counts are kept in triangular int32 arrays, otherwise in an open-addressing
+        hash table of the keys. maxpairs bounds the pairs in the hash table (MAXPAIRS by default, 0 for
+        no bound), the oldest pairs are dropped to make room.
+        Counts not stored are returned as -1.
+        load and save keep the pairs in a .npz file between runs, together with the names of the
+        samples and a digest of their genotypes. Pairs with a new or changed sample are dropped on load.
+    """
+    DENSE = 1 << 24 # Most pairs kept in the triangular arrays, 128 MB
+    MAXPAIRS = 1 << 22 # Default bound of the hash table, 100-200 MB at 24 bytes a slot and at most half the slots used
+
+    def __init__(self,n,maxpairs=MAXPAIRS,verbose=False):
+        self.n = n
+        self.maxpairs = maxpairs
+        self.verbose = verbose
+        npairs = n*(n-1)//2
+        self.dense = npairs <= self.DENSE and (not maxpairs or npairs <= 6*maxpairs) # 8 bytes a pair against 48
+        if self.dense:
+            self.wrong = np.zeros(npairs,dtype=np.int32)-1
+            self.info = np.zeros(npairs,dtype=np.int32)
+        else:
+            self.newTable(1024)
+        self.stamp = 0 # Insertions so far, the age of a pair in the hash table
+
+    def __len__(self):
+        if self.dense: return int(np.count_nonzero(self.wrong >= 0))
+        return self.size
+
+    def pairKeys(self,i,j):
+        # Key of every pair (i,j), the same for (j,i)
+        i,j = np.asarray(i,dtype=np.int64).ravel(),np.asarray(j,dtype=np.int64).ravel()
+        lo,hi = np.minimum(i,j),np.maximum(i,j)
+        return np.where(lo == hi,-1,hi*(hi-1)//2+lo) # A sample with itself is never stored
+
+    def pairs(self,keys):
+        # The pairs (lo,hi) of keys made by pairKeys
+        hi = np.floor((1+np.sqrt(1+8*keys.astype(np.float64)))/2).astype(np.int64)
+        hi[hi*(hi-1)//2 > keys] -= 1
+        hi[(hi+1)*hi//2 <= keys] += 1
+        return keys-hi*(hi-1)//2,hi
+
+    def newTable(self,size):
+        # Empty hash table with room for size slots, a power of two
+        self.keys = np.zeros(size,dtype=np.int64)-1
+        self.wrong = np.zeros(size,dtype=np.int32)
+        self.info = np.zeros(size,dtype=np.int32)
+        self.age = np.zeros(size,dtype=np.int64)
+        self.size = 0
+
+    def slots(self,keys,insert=False):
+        """
+            Returns the slot of every key in the hash table, -1 for keys not there
+            With insert, keys not there are given an empty slot. keys must be unique
+        """
+        mask = len(self.keys)-1
+        shift = np.uint64(64-int(np.log2(len(self.keys))))
+        pos = ((keys.astype(np.uint64)*np.uint64(11400714819323198485)) >> shift).astype(np.int64)
+        res = np.zeros(len(keys),dtype=np.int64)-1
+        todo = np.arange(len(keys))
+        while len(todo):
+            found = self.keys[pos[todo]]
+            hit = found == keys[todo]
+            res[todo[hit]] = pos[todo[hit]]
+            empty = found == -1
+            claimed = np.zeros(len(todo),dtype=bool)
+            if insert and empty.any():
+                # Only the first of the keys probing the same empty slot takes it
+                free = np.nonzero(empty)[0]
+                first = free[np.unique(pos[todo[free]],return_index=True)[1]]
+                self.keys[pos[todo[first]]] = keys[todo[first]]
+                res[todo[first]] = pos[todo[first]]
+                claimed[first] = True
+                self.size += len(first)
+            todo = todo[~hit & ~claimed & (insert | ~empty)]
+            pos[todo] = (pos[todo]+1) & mask
+        return res
+
+    def get(self,i,j):
+        """ Returns the stored discords and informative sites of the pairs (i,j), -1 for pairs not stored """
+        keys = self.pairKeys(i,j)
+        wrong,info = np.zeros(len(keys),dtype=np.int32)-1,np.zeros(len(keys),dtype=np.int32)-1
+        if self.dense:
+            ok = keys >= 0
+            wrong[ok],info[ok] = self.wrong[keys[ok]],self.info[keys[ok]]
+            return wrong,info
+        slots = self.slots(keys)
+        ok = (keys >= 0) & (slots >= 0)
+        wrong[ok],info[ok] = self.wrong[slots[ok]],self.info[slots[ok]]
+        return wrong,info
+
+    def put(self,i,j,wrong,info):
+        """ Stores the discords and informative sites of the pairs (i,j) """
+        keys = self.pairKeys(i,j)
+        wrong,info = np.asarray(wrong).ravel(),np.asarray(info).ravel()
+        ok = keys >= 0
+        keys,wrong,info = keys[ok],wrong[ok],info[ok]
+        if self.dense:
+            self.wrong[keys],self.info[keys] = wrong,info
+            return
+        # The last count of a pair given more than once, the pairs in the order given so the ages follow it
+        keys,last = np.unique(keys[::-1],return_index=True)
+        last = len(wrong)-1-last
+        order = np.argsort(last,kind='stable')
+        keys,last = keys[order],last[order]
+        wrong,info = wrong[last],info[last]
+        if self.maxpairs and len(keys) > self.maxpairs:
+            keys,wrong,info = keys[-self.maxpairs:],wrong[-self.maxpairs:],info[-self.maxpairs:]
+        if self.maxpairs and self.size+len(keys) > self.maxpairs: self.evict(self.maxpairs-len(keys))
+        if 2*(self.size+len(keys)) > len(self.keys): self.rehash(2*(self.size+len(keys)))
+        slots = self.slots(keys,True)
+        self.wrong[slots],self.info[slots] = wrong,info
+        self.age[slots] = self.stamp+np.arange(len(keys))
+        self.stamp += len(keys)
+
+    def entries(self):
+        # Keys and counts of every stored pair, oldest first
+        if self.dense:
+            keys = np.nonzero(self.wrong >= 0)[0].astype(np.int64)
+            return keys,self.wrong[keys],self.info[keys]
+        used = np.nonzero(self.keys >= 0)[0]
+        used = used[np.argsort(self.age[used],kind='stable')]
+        return self.keys[used],self.wrong[used],self.info[used]
+
+    def rehash(self,size):
+        # Moves the pairs into a table with at least size slots
+        keys,wrong,info = self.entries()
+        age = np.sort(self.age[self.keys >= 0])
+        self.newTable(1 << max(10,int(np.ceil(np.log2(size)))))
+        slots = self.slots(keys,True)
+        self.wrong[slots],self.info[slots],self.age[slots] = wrong,info,age
+
+    def evict(self,keep):
+        # Drops the oldest pairs, keeping at most keep of them
+        keys,wrong,info = self.entries()
+        age = np.sort(self.age[self.keys >= 0])
+        start = max(len(keys)-max(keep,0),0)
+        if self.verbose: sys.stdout.write('Pair cache: dropped %d of %d pairs\n' % (start,len(keys)))
+        keys,wrong,info,age = keys[start:],wrong[start:],info[start:],age[start:]
+        self.newTable(len(self.keys))
+        slots = self.slots(keys,True)
+        self.wrong[slots],self.info[slots],self.age[slots] = wrong,info,age
+
+    def load(self,path,names,digests):
+        """
+            Adds the pairs stored in path, names and digests are those of the samples numbered
+            from 0 in this run. Returns the number of pairs added.
+        """
+        try:
+            with np.load(path) as data: res = dict((k,data[k]) for k in data.files)
+        except (IOError,OSError,ValueError):
+            return 0
+        current = dict((name,i) for i,name in enumerate(names))
+        # Position of every stored sample in this run, -1 if it is new or has changed
+        index = np.array([current.get(name,-1) for name in res['names']],dtype=np.int64)
+        same = np.array([i >= 0 and digests[i] == digest for i,digest in zip(index,res['digests'])],dtype=bool)
+        index[~same] = -1
+        lo,hi = self.pairs(res['keys'])
+        ok = (index[lo] >= 0) & (index[hi] >= 0)
+        self.put(index[lo[ok]],index[hi[ok]],res['wrong'][ok],res['info'][ok])
+        if self.verbose: sys.stdout.write('Pair cache: %d of %d stored pairs used from %s\n' % (np.count_nonzero(ok),len(ok),path))
+        return int(np.count_nonzero(ok))
+
+    def save(self,path,names,digests):
+        """ Stores the pairs, replacing the file only when it is completely written """
+        keys,wrong,info = self.entries()
+        tmp = path+'.tmp%d' % os.getpid()
+        with open(tmp,'wb') as fout: np.savez(fout,names=np.array(names),digests=np.array(digests),keys=keys,wrong=wrong,info=info)
+        os.rename(tmp,path)
+        if self.verbose: sys.stdout.write('Pair cache: stored %d pairs in %s\n' % (len(keys),path))
+
+class ReportWriter(object):
+    """
+        Writes a report file in chunks of about chunk bytes as the lines arrive, so that the
+        report is never held in memory and what is written survives a crash
+        With lazy the file and its header are only written with the first line, a report without
+        lines is then not created. With background the chunks are written by a thread of their own
+        while the caller goes on, at most a few chunks are queued.
+        What is buffered is also written if the program stops on an exception.
+    """
+
+    def __init__(self,path,header='',chunk=1<<20,lazy=False,background=False):
+        self.path = path
+        self.header = header
+        self.chunk = chunk
+        self.background = background
+        self.buf,self.nbuf = [],0
+        self.fout = self.thread = self.error = None
+        self.closed = False
+        if not lazy: self.start()
+
+    def start(self):
+        # Creates the file, or the thread writing it, with the header as the first text
+        if self.background:
+            self.queue = Queue.Queue(4)
+            self.thread = threading.Thread(target=self.writeQueued)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.fout = open(self.path,'w')
+        self.buf,self.nbuf = [self.header],len(self.header)
+        atexit.register(self.close)
+
+    def write(self,text):
+        if self.fout is None and self.thread is None: self.start()
+        self.buf.append(text)
+        self.nbuf += len(text)
+        if self.nbuf >= self.chunk: self.flush()
+
+    def flush(self):
+        """ Writes the buffered text """
+        text = ''.join(self.buf)
+        self.buf,self.nbuf = [],0
+        if self.thread:
+            if self.error: raise self.error
+            self.queue.put(text)
+            return
+        self.fout.write(text)
+        self.fout.flush()
+
+    def writeQueued(self):
+        # The background thread, writes the queued chunks until it gets None
+        try:
+            self.fout = open(self.path,'w')
+            while True:
+                text = self.queue.get()
+                if text is None: break
+                self.fout.write(text)
+                self.fout.flush()
+        except (IOError,OSError) as e:
+            self.error = e
+            while self.queue.get() is not None: pass # Lets the caller go on to close
+        if self.fout: self.fout.close()
+
+    def close(self):
+        """ Writes what is left and closes the file, a lazy report without lines is not created """
+        if self.closed or (self.fout is None and self.thread is None): return
+        self.closed = True
+        if self.buf: self.flush()
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            if self.error: raise self.error
+            return
+        self.fout.close()
+
+def cpuTime():
+    """ CPU time (user and system) of this process and its finished child processes """
+    t = os.times()
+    return t[0]+t[1]+t[2]+t[3]
+
+def peakRSS(who='self'):
+    """ Peak resident memory in MB of this process, or of its largest finished child process """
+    if resource is None: return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    if sys.platform == 'darwin': return round(usage.ru_maxrss / 1048576.0,1) # Bytes instead of kB
+    return round(usage.ru_maxrss / 1024.0,1)
+
+class Profile(object):
+    """
+        Wall time, CPU time, peak memory and item counts for the stages of a run, written as JSON
+        A stage lasts until the next one starts or the report is written. Without an output file
+        every method returns at once.
+        Peak memory is the peak of the process so far, CPU time includes finished worker processes.
+    """
+    def __init__(self,outfile,tool):
+        self.outfile = outfile
+        if not outfile: return
+        self.tool = tool
+        self.stages = []
+        self.current = None
+        self.wall,self.cpu = time.time(),cpuTime()
+
+    def stage(self,name,**counts):
+        """ Ends the current stage and starts the next one """
+        if not self.outfile: return
+        self.end()
+        self.current = {'stage':name,'counts':counts,'wall':time.time(),'cpu':cpuTime()}
+
+    def count(self,**counts):
+        """ Adds item counts to the current stage """
+        if not self.outfile or self.current is None: return
+        self.current['counts'].update(counts)
+
+    def end(self):
+        # Closes the current stage
+        if not self.outfile or self.current is None: return
+        stage = self.current
+        stage['wall'] = round(time.time()-stage['wall'],4)
+        stage['cpu'] = round(cpuTime()-stage['cpu'],4)
+        stage['maxrss_mb'] = peakRSS()
+        self.stages.append(stage)
+        self.current = None
+
+    def write(self):
+        """ Ends the last stage and writes the report """
+        if not self.outfile: return
+        self.end()
+        report = {'tool':self.tool,'argv':sys.argv,
+                  'wall':round(time.time()-self.wall,4),'cpu':round(cpuTime()-self.cpu,4),
+                  'maxrss_mb':peakRSS(),'children_maxrss_mb':peakRSS('children'),
+                  'stages':self.stages}
+        with open(self.outfile,'w') as fout:
+            json.dump(report,fout,indent=1,sort_keys=True)
+            fout.write('\n')
@@ -3,20 +3,219 @@
 # snpstat, version 1.0, 2014-03-14
 
 from __future__ import division, print_function
+import os
 import sys
 import argparse
+import hashlib
+import heapq
+import tempfile
+import multiprocessing
 import numpy as np
+import libSNP
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# Number of set bits in every possible byte, used when numpy lacks bitwise_count
+POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)],dtype=np.uint8)
+
+def popcount(words):
+    """ Returns the total number of set bits in an array of 64-bit words """
+    if hasattr(np,'bitwise_count'): return int(np.bitwise_count(words).sum())
+    return int(POPCOUNT8[np.ascontiguousarray(words).view(np.uint8)].sum())
+
+def packBits(bits):
+    """
+        np.packbits along the last axis with the first bit in the lowest bit of each byte
+        (bitorder='little', which numpy only has from 1.17)
+    """
+    pad = -bits.shape[-1] % 8
+    if pad: bits = np.concatenate([bits,np.zeros(bits.shape[:-1]+(pad,),dtype=bits.dtype)],axis=-1)
+    return np.packbits(bits.reshape(bits.shape[:-1]+(-1,8))[...,::-1],axis=-1).reshape(bits.shape[:-1]+(-1,))
+
+def unpackBits(data):
+    # Reverses packBits, np.unpackbits along the last axis with the lowest bit of each byte first
+    bits = np.unpackbits(data[...,None],axis=-1)[...,::-1]
+    return bits.reshape(data.shape[:-1]+(-1,))
+
+def packGenos(row):
+    """
+        Packs a row of genotypes coded as -1/0/1 (nan for missing) into two bit planes,
+        2 bits per call: missing = 00, hom-ref = 01, het = 11, hom-alt = 10
+        Returns an array of shape (2,words) of 64-bit words
+    """
+    called = ~np.isnan(row)
+    lo = packBits(called & (np.nan_to_num(row) <= 0))
+    hi = packBits(called & (np.nan_to_num(row) >= 0))
+    nbytes = ((len(row)+63)//64)*8
+    planes = np.zeros((2,nbytes),dtype=np.uint8)
+    planes[0,:len(lo)] = lo
+    planes[1,:len(hi)] = hi
+    return planes.view(np.uint64)
+
+def unpackGenos(planes,nmark):
+    """ Reverses packGenos, returns a float row with nan for missing calls """
+    bits = unpackBits(np.ascontiguousarray(planes).view(np.uint8))
+    lo,hi = bits[0,:nmark].astype(bool),bits[1,:nmark].astype(bool)
+    row = np.zeros(nmark)
+    row[lo & ~hi] = -1
+    row[hi & ~lo] = 1
+    row[~(lo | hi)] = np.nan
+    return row
+
+def indicators(block,dtype=np.float32):
+    """
+        Converts a block of genotypes coded as -1/0/1 (nan or libSNP.MISSING for missing) into
+        hom-ref, hom-alt and called indicator matrices
+    """
+    called = libSNP.called(block)
+    return ((block == -1).astype(dtype),
+            (block == 1).astype(dtype),
+            called.astype(dtype))
+
+def packedIndicators(block,nmark,dtype=np.float32):
+    """ Same as indicators, for a block of packed rows """
+    bits = unpackBits(np.ascontiguousarray(block).view(np.uint8))
+    lo,hi = bits[:,0,:nmark],bits[:,1,:nmark]
+    return ((lo > hi).astype(dtype),
+            (hi > lo).astype(dtype),
+            (lo | hi).astype(dtype))
+
+def pairCounts(ind1,ind2):
+    """
+        Counts opposite homozygotes and informative sites for every pair of rows
+        in two blocks of indicator matrices, using matrix products
+        Returns two integer matrices of shape (rows1,rows2)
+    """
+    r1,a1,n1 = ind1
+    r2,a2,n2 = ind2
+    disc = np.dot(r1,a2.T) + np.dot(a1,r2.T)
+    sites = np.dot(n1,n2.T)
+    return disc.astype(np.int64),sites.astype(np.int64)
+
+def equalCounts(ind1,ind2):
+    """
+        Counts identical calls and informative sites for every pair of rows in two
+        blocks of indicator matrices, using matrix products
+    """
+    r1,a1,n1 = ind1
+    r2,a2,n2 = ind2
+    equal = np.dot(r1,r2.T) + np.dot(a1,a2.T) + np.dot(n1-r1-a1,(n2-r2-a2).T)
+    sites = np.dot(n1,n2.T)
+    return equal.astype(np.int64),sites.astype(np.int64)
+
+def trioCounts(indA,indF,indM,hasF,hasM):
+    """
+        Counts discords and informative sites for a block of trios, given boolean
+        indicator matrices for offspring, fathers and mothers (one trio per row)
+        hasF and hasM tell which rows have a genotyped offspring and father/mother,
+        the rows of the others are ignored.
+        Follows findDiscords: trio discords are counted on all markers, trio sites only
+        where every available comparison is informative
+        Returns discords and sites for father, mother and trio as six arrays
+    """
+    rA,aA,nA = indA
+    rF,aF,nF = indF
+    rM,aM,nM = indM
+    hasF,hasM = hasF[:,None],hasM[:,None]
+    hasT = hasF & hasM
+    wrongF = ((rF & aA) | (aF & rA)) & hasF
+    wrongM = ((rM & aA) | (aM & rA)) & hasM
+    # Parents homozygous for the same allele and a heterozygous offspring
+    wrongT = ((rF & rM) | (aF & aM)) & (nA & ~rA & ~aA) & hasT
+    okF,okM = nF & nA,nM & nA
+    ok = (okF | ~hasF) & (okM | ~hasM) & ((okF & nM) | ~hasT)
+    return (wrongF.sum(1),(okF & hasF).sum(1),
+            wrongM.sum(1),(okM & hasM).sum(1),
+            (wrongF | wrongM | wrongT).sum(1),ok.sum(1))
+
+def coupleCounts(indA,indF,indM):
+    """
+        Counts trio discords and informative sites of one offspring against every pair of a
+        potential father and mother, using matrix products. indA holds the boolean indicators of
+        the offspring (one row), indF and indM those of the fathers and mothers.
+        A discord against one parent needs a homozygous offspring and a trio discord a heterozygous
+        one, so the union counted by findDiscords is |wrongF| + |wrongM| - |wrongF & wrongM| + |wrongT|
+        Returns two integer matrices of shape (fathers,mothers)
+    """
+    rA,aA,nA = indA
+    hA = nA & ~rA & ~aA
+    def parts(ind):
+        r,a,n = ind
+        return [x.astype(np.float32) for x in [(r & aA) | (a & rA),r & hA,a & hA,n & nA]]
+    wF,rF,aF,nF = parts(indF)
+    wM,rM,aM,nM = parts(indM)
+    disc = wF.sum(1)[:,None] + wM.sum(1)[None,:] - np.dot(wF,wM.T) + np.dot(rF,rM.T) + np.dot(aF,aM.T)
+    sites = np.dot(nF,nM.T)
+    return disc.astype(np.int64),sites.astype(np.int64)
+
+def pushTop(heap,k,pct,sites,j,disc):
+    """
+        Keeps the k best parents of a sample in a heap, ranked on discord percentage, then on
+        informative sites (most first), then on position j among the parents. The worst is on top.
+    """
+    item = (-pct,sites,-j,disc)
+    if len(heap) < k: heapq.heappush(heap,item)
+    elif item > heap[0]: heapq.heapreplace(heap,item)
+
+# The SNP object used by worker processes, inherited when the workers are forked
+_shared = None
+
+def _runShard(job):
+    # Runs one shard of a search in a worker process and returns its output
+    method,shard,args = job
+    out = StringIO()
+    _shared.exitstats = dict((k,0) for k in _shared.exitstats)
+    found = getattr(_shared,method)(out,shard,*args)
+    return out.getvalue(),found or 0,_shared.exitstats
 
 class SNP(object):
 
-    def __init__(self,ic,ia,informat,verbose):
+    def __init__(self,ic,ia,informat,verbose,store='float'):
         """
             ic = number of information columns before genotypes start
             ia = allele representation, 1 = 0/1/2, 2 = 11/13/33, 3 = 1 1/1 3/3 3
                  for 2 and 3, alleles are represented as 1/2/3/4
+            store = genotype storage, 'float' keeps one float per call,
+                    'int8' keeps one byte per call with libSNP.MISSING for missing calls,
+                    'packed' keeps 2 bits per call in 64-bit words
         """
         self.verbose = verbose
         self.sep = '\t'
+        if store not in ['float','int8','packed']:
+            sys.stderr.write('Unknown genotype store: "%s"\n' % store)
+            sys.exit(1)
+        self.store = store
+        self.blocksize = 256 # Samples per block in the batched pair searches
+        self.workers = 1 # Number of worker processes for the pair searches
+        self.cache = None # libSNP.GenoCache for parsed genotype files
+        self.cached = {} # Cache entries used in this run
+        self.rebuild = False # Parse the genotype files again and replace the cache entries
+        self.screen = 0 # Markers in the screening panel of findparent/findped, 0 = no screening
+        self.screenlimit = None # Noise level for passing the screen, default twice the limit
+        self.screensample = 1000 # Rejected pairs checked on all markers to estimate false negatives
+        self.candidates = None # Parents passing the screen for every sample
+        self.lsh = False # Propose duplicate pairs by locality-sensitive hashing instead of comparing all pairs
+        self.lshrecall = 0.99 # Wanted probability of proposing a pair at the difference limit
+        self.lshrows = 20 # Markers hashed together in every band
+        self.lshlimit = 1.0 # Percent differences of the pairs written by the LSH search
+        self.lshmaxbands = 1000 # Most hash bands, a limit needing more is refused
+        self.results = None # libSNP.ResultStore with the pair counts of earlier findparent runs
+        self.topk = 0 # Parents written per sample in findparent, best first, 0 = all within the limit
+        self.prune = False # Skip parents ruled out by the pedigree (descendants, birth years)
+        self.birthcol = None # Column (from 1) of the birth year in the pedigree file
+        self.minage = 1 # Smallest difference in birth year between a parent and its offspring
+        self.pruneindex = None # Birth years and positions of the potential parents, see buildPruneIndex
+        self.prunegroup = 64 # Smallest group of samples, by birth year, scored against the parents allowed for any of them
+        self.stream = 0 # Reference samples per batch when the reference file is streamed by findparent, 0 = read it whole
+        self.streamfile = None # Reference file left to findParentStream
+        self.spare = 0 # Rows kept free after the samples, for query samples added later by pedserver.py
+        self.index = False # Check reads only the rows it needs, through a libSNP.RowIndex of each genotype file
+        self.memlimit = None # Bytes for the working set, the genotypes are then kept in a disk-backed file
+        self.earlyexit = False # Stop counting a pair in findSingleDiscords and the block searches once it can not pass the limit
+        self.exitstep = 512 # Markers counted before the first early exit test, a multiple of 64
+        self.exitstats = {'pairs':0,'stopped':0,'scanned':0,'markers':0}
         if not informat:
             self.ic = ic
             self.ia = ia
@@ -75,7 +274,7 @@ class SNP(object):
         if a[0] != a[1]: return '1'
         if a[0] == m1: return '0'
         if a[0] == m2: return '2'
-        if a[0] != '0': sys.stderr.write('ERROR: Marker %s has more than 2 alleles: [%s]\n' % mark,str(a))
+        if a[0] != '0': sys.stderr.write('ERROR: Marker %s has more than 2 alleles: [%s]\n' % (mark,str(a)))
         return np.nan
 
     def readGenos(self,genofile,referencefile=None):
@@ -86,50 +285,423 @@ class SNP(object):
           11/13/33 (-a 2),
           1 1/1 3/3 3 (-a 3)
         """
-        if referencefile: self.gen = np.zeros((len(self.ped1)+len(self.ped2),len(self.mark)))
-        else: self.gen = np.zeros((len(self.ped1),len(self.mark)))
-        self.gen[:] = np.nan
-        with open(genofile,'r') as fin:
+        if referencefile and self.stream:
+            # Only the query samples are read here, the reference batches go in the rows after them
+            self.newGenos(len(self.ped1)+self.stream)
+            self.loadAlleles()
+            self.readGenoFile(genofile,self.ped1)
+            self.streamfile = referencefile
+            return
+        if referencefile: self.newGenos(len(self.ped1)+len(self.ped2)+self.spare)
+        else: self.newGenos(len(self.ped1)+self.spare)
+        self.loadAlleles()
+        self.readGenoFile(genofile,self.ped1)
+        if not referencefile: return
+        self.readGenoFile(referencefile,self.ped2)
+
+    def readGenoFile(self,genofile,ped):
+        # Fills in the rows of the samples in one genotype file, rows are given by ped
+        if libSNP.isPlink(genofile):
+            self.readPlink(genofile,ped)
+            self.saveAlleles()
+            return
+        if self.cache:
+            self.readCached(self.cacheEntry(genofile),ped)
+            self.saveAlleles()
+            return
+        with libSNP.openFile(genofile) as fin:
             for line in fin:
                 if line.startswith('#'):
                     mlist = line.strip('#').strip().split()
+                    # Positions in the header of the known markers, and their ranks
+                    pos = np.array([i for i,mark in enumerate(mlist) if mark in self.mark],dtype=int)
+                    icols = np.array([self.mark[mlist[i]]['rank'] for i in pos],dtype=int)
                     continue
                 l = line.strip().split()
                 if len(l) < 1: continue
-                irow = self.ped1[l[self.nc]]['rank']
-                for i,mark  in enumerate(mlist):
-                    if mark not in self.mark: continue
-                    icol = self.mark[mark]['rank']
-                    if self.ia == 1:
-                        a = l[i+self.ic]
-                    elif self.ia == 2: 
-                        a = self.tbase012(l[i+self.ic],mark)
-                    elif self.ia == 3:
-                        a = self.tbase012(l[i*2+self.ic]+l[i*2+1+self.ic],mark)
-                    if a not in ['0','1','2']: a = np.nan
-                    else: a = int(a)
-                    self.gen[irow,icol] = a-1
-        if not referencefile: return
-        with open(referencefile,'r') as fin:
+                irow = ped[l[self.nc]]['rank']
+                self.setGenos(irow,icols,libSNP.parseGenos(l,self.ic,self.ia,len(mlist),pos,icols,self.alleles,self.marklist))
+        self.saveAlleles()
+
+    def singlePass(self,file1,file2):
+        # True when the genotype files can be read by ingest, binary Plink and cached files are read in steps
+        if self.cache: return False
+        return not any(libSNP.isPlink(infile) for infile in [file1,file2] if infile)
+
+    def ingest(self,pedfile,file1,file2,markerfile):
+        """
+            Reads the samples, markers and genotypes of the text genotype files in one pass per file,
+            the same as collectPedigree, readMarkers/collectMarkers and readGenos
+            The markers are taken from the header of file1 when there is no marker file. The samples
+            get rows in a genotype store that grows as they are found, and is cut to size at the end.
+        """
+        self.mark,self.marklist = {},[]
+        if markerfile: self.readMarkers(markerfile)
+        if pedfile: self.ped,self.pedlist = self.readPedigree(pedfile)
+        self.gen = None
+        self.ped1,self.names1 = self.ingestFile(file1,0)
+        if not pedfile: self.ped,self.pedlist = self.ped1,self.names1
+        if file2 and self.stream:
+            # The reference batches go in the rows after the query samples
+            self.ped2,self.names2 = {},[]
+            self.streamfile = file2
+            nrows = len(self.ped1)+self.stream
+        elif file2:
+            self.ped2,self.names2 = self.ingestFile(file2,len(self.ped1))
+            nrows = len(self.ped1)+len(self.ped2)+self.spare
+        else:
+            self.ped2,self.names2 = self.ped1,self.names1
+            nrows = len(self.ped1)+self.spare
+        self.resizeGenos(nrows)
+
+    def ingestFile(self,genofile,count):
+        # Reads the pedigree and genotypes of one file for ingest, the samples get the rows from count on
+        ped,pedlist = {},[]
+        icols = None
+        size,done = libSNP.textSize(genofile),0 # Bytes of text, and characters read (about the same)
+        with libSNP.openFile(genofile) as fin:
             for line in fin:
+                done += len(line)
                 if line.startswith('#'):
                     mlist = line.strip('#').strip().split()
+                    if not self.marklist: self.headerMarkers(mlist)
+                    pos = np.array([i for i,mark in enumerate(mlist) if mark in self.mark],dtype=int)
+                    icols = np.array([self.mark[mlist[i]]['rank'] for i in pos],dtype=int)
                     continue
                 l = line.strip().split()
                 if len(l) < 1: continue
-                irow = self.ped2[l[self.nc]]['rank']
-                for i,mark  in enumerate(mlist):
-                    if mark not in self.mark: continue
-                    icol = self.mark[mark]['rank']
-                    if self.ia == 1:
-                        a = l[i+self.ic]
-                    elif self.ia == 2:
-                        a = self.tbase012(l[i+self.ic],mark)
-                    elif self.ia == 3:
-                        a = self.tbase012(l[i*2+self.ic]+l[i*2+1+self.ic],mark)
-                    if a not in ['0','1','2']: a = np.nan
-                    else: a = int(a)
-                    self.gen[irow,icol] = a-1
+                if icols is None:
+                    sys.stderr.write('ERROR: No marker header in %s\n' % genofile)
+                    sys.exit(1)
+                name,entry = self.pedEntry(l,count,False)
+                if name == '0': continue
+                if name not in ped:
+                    ped[name] = entry
+                    count += 1
+                    pedlist.append(name)
+                else:
+                    sys.stderr.write('%s present more than once\n' % name)
+                irow = ped[name]['rank']
+                if self.gen is None or irow >= len(self.gen):
+                    # Room for as many lines of this length as are left in the file, the store
+                    # doubles if the size of the file was wrong
+                    nrows = self.blocksize
+                    if size > done: nrows = max(nrows,(size-done)//len(line)+1)
+                    elif self.gen is not None: nrows = max(nrows,len(self.gen))
+                    if self.gen is None:
+                        self.newGenos(irow+nrows)
+                        self.loadAlleles()
+                    else:
+                        self.resizeGenos(irow+nrows)
+                self.setGenos(irow,icols,libSNP.parseGenos(l,self.ic,self.ia,len(mlist),pos,icols,self.alleles,self.marklist))
+        if self.gen is None:
+            self.newGenos(count)
+            self.loadAlleles()
+        self.saveAlleles()
+        self.updatePed(ped)
+        return ped,pedlist
+
+    def canIndex(self,file1,file2):
+        # True when the genotype files can be read through a libSNP.RowIndex
+        if self.cache or self.stream: return False
+        return not any(libSNP.isPlink(infile) or infile.endswith('.gz') for infile in [file1,file2] if infile)
+
+    def readIndexed(self,pedfile,file1,file2,markerfile):
+        """
+            Same as ingest for the check mode, reading only the rows that check uses: the animals in
+            the pedigree and their parents. The lines of these samples are found through a
+            libSNP.RowIndex of each genotype file, the other lines are not read.
+            The alleles of markers without alleles in the marker file are learnt from the rows read.
+        """
+        index1 = libSNP.RowIndex(file1,self.nc,self.verbose)
+        index2 = libSNP.RowIndex(file2,self.nc,self.verbose) if file2 else index1
+        self.mark,self.marklist = {},[]
+        if markerfile: self.readMarkers(markerfile)
+        elif len(index1.headers): self.headerMarkers(index1.header(0))
+        # Samples checked and their parents, the rows are numbered over these. The parents in the
+        # genotype files are only read from the index without a pedigree file, every sample is then checked
+        if pedfile:
+            self.ped,self.pedlist = self.readPedigree(pedfile)
+            need1 = set(index1.samples(index1.find(self.pedlist)))
+            need2 = set(self.ped[sample][parent] for sample in need1 for parent in ['father','mother'])
+            if not file2: need1 |= need2
+            self.ped1,self.names1 = self.indexPedigree(index1,index1.find(need1),0,False)
+        else:
+            self.ped,self.pedlist = self.indexPedigree(index1,np.arange(len(index1.names)))
+            need2 = set(self.ped[sample][parent] for sample in self.pedlist for parent in ['father','mother'])
+            self.ped1,self.names1 = self.ped,self.pedlist
+        if file2: self.ped2,self.names2 = self.indexPedigree(index2,index2.find(need2),len(self.names1),False)
+        else: self.ped2,self.names2 = self.ped1,self.names1
+        self.newGenos(len(self.names1)+(len(self.names2) if file2 else 0)+self.spare)
+        self.loadAlleles()
+        self.readIndexRows(index1,self.ped1)
+        if file2: self.readIndexRows(index2,self.ped2)
+
+    def indexPedigree(self,index,rows,count=0,parents=True):
+        # The pedigree of readPedigree for the given lines of an indexed genotype file, without parents if not asked for
+        if parents: lines = [['0']*self.nc+fields for fields in index.pedigree(rows)]
+        else: lines = [['0']*self.nc+[name] for name in index.samples(rows)]
+        return self.pedigreeLines(lines,count,False)
+
+    def readIndexRows(self,index,ped):
+        # Fills in the rows of the samples in ped from the lines found by the index
+        headers = {}
+        for i,line in index.lines(index.find(ped)):
+            h = index.rowheader[i]
+            if h < 0:
+                sys.stderr.write('ERROR: No marker header in %s\n' % index.infile)
+                sys.exit(1)
+            if h not in headers:
+                mlist = index.header(h)
+                pos = np.array([j for j,mark in enumerate(mlist) if mark in self.mark],dtype=int)
+                headers[h] = (len(mlist),pos,np.array([self.mark[mlist[j]]['rank'] for j in pos],dtype=int))
+            nmark,pos,icols = headers[h]
+            l = line.strip().split()
+            self.setGenos(ped[l[self.nc]]['rank'],icols,libSNP.parseGenos(l,self.ic,self.ia,nmark,pos,icols,self.alleles,self.marklist))
+        self.saveAlleles()
+
+    def streamBatches(self,referencefile):
+        """
+            Reads a text reference file self.stream samples at a time into the rows after the query samples
+            Yields the samples of every batch, as a dict in the same form as ped2 and in file order.
+            A sample is read again if its lines are in different batches.
+        """
+        first = len(self.ped1)
+        batch = {}
+        with libSNP.openFile(referencefile) as fin:
+            for line in fin:
+                if line.startswith('#'):
+                    mlist = line.strip('#').strip().split()
+                    pos = np.array([i for i,mark in enumerate(mlist) if mark in self.mark],dtype=int)
+                    icols = np.array([self.mark[mlist[i]]['rank'] for i in pos],dtype=int)
+                    continue
+                l = line.strip().split()
+                if len(l) < 1 or l[self.nc] == '0': continue
+                name = l[self.nc]
+                if name not in batch:
+                    if len(batch) == self.stream:
+                        yield batch
+                        batch = {}
+                    batch[name] = {'father':'0','mother':'0','rank':first+len(batch),'sex':'3','born':np.nan,'children':[]}
+                    self.clearGenos(batch[name]['rank'])
+                self.setGenos(batch[name]['rank'],icols,libSNP.parseGenos(l,self.ic,self.ia,len(mlist),pos,icols,self.alleles,self.marklist))
+        self.saveAlleles()
+        if batch: yield batch
+
+    def loadAlleles(self):
+        # Sets up the per-marker allele state used by libSNP.codeAlleles from the marker information
+        self.alleles = libSNP.newAlleles(len(self.marklist))
+        for mark in self.marklist:
+            alleles,icol = self.mark[mark]['alleles'],self.mark[mark]['rank']
+            for i,allele in enumerate(alleles[:2]): self.alleles[i][icol] = ord(allele)
+            self.alleles[2][icol] = min(len(alleles),2)
+
+    def saveAlleles(self):
+        # Copies the alleles found by libSNP.codeAlleles back into the marker information
+        if self.ia == 1: return
+        for icol in np.nonzero(self.alleles[2])[0]:
+            alleles = [chr(self.alleles[0][icol]),chr(self.alleles[1][icol])]
+            self.mark[self.marklist[icol]]['alleles'] = alleles[:self.alleles[2][icol]]
+
+    def cacheEntry(self,genofile):
+        # Returns the parsed genotype file from the cache, parsing and storing it first if needed
+        if genofile in self.cached: return self.cached[genofile]
+        options = {'ic':self.ic,'ia':self.ia,'nc':self.nc}
+        entry = None
+        if not self.rebuild: entry = self.cache.load(genofile,options)
+        if entry is None:
+            entry = libSNP.readGenoFile(genofile,self.ic,self.ia,self.nc)
+            self.cache.save(genofile,options,entry)
+        self.cached[genofile] = entry
+        return entry
+
+    def readCached(self,entry,ped):
+        """
+            Fills in the rows of the samples in a cached genotype file
+            The cached calls are coded with the alleles found in that file alone, they
+            are recoded to the alleles already known for each marker
+            Calls with a third allele in that file are recoded one by one
+        """
+        keep = np.array([j for j,mark in enumerate(entry['markers']) if mark in self.mark],dtype=int)
+        icols = np.array([self.mark[entry['markers'][j]]['rank'] for j in keep],dtype=int)
+        # Codes given to cached hom-ref and hom-alt calls
+        codes = self.alleleCodes(icols,[entry['alleles'][j] for j in keep])
+        irows = np.array([ped[sample]['rank'] for sample in entry['samples']],dtype=int)
+        for start in range(0,len(irows),self.blocksize):
+            block = entry['genos'][start:start+self.blocksize][:,keep]
+            vals = np.where(block == -1,codes[0],np.where(block == 1,codes[1],0.0))
+            vals[block == libSNP.MISSING] = np.nan
+            self.setGenoBlock(irows[start:start+self.blocksize],icols,vals)
+        # Calls with a third allele in the cached file, the allele may be known here
+        odd = [(i,self.mark[entry['markers'][j]]['rank'],call) for i,j,call in entry['odd'] if entry['markers'][j] in self.mark]
+        if not odd: return
+        x = np.array([ord(call[0]) for i,col,call in odd],dtype=np.int32)
+        y = np.array([ord(call[1]) for i,col,call in odd],dtype=np.int32)
+        vals = libSNP.codeAlleles(x,y,np.array([col for i,col,call in odd],dtype=int),self.alleles,self.marklist)
+        for (i,col,call),val in zip(odd,vals): self.setGenos(irows[i],[col],[val])
+
+    def alleleCodes(self,icols,found):
+        """
+            Returns the codes (2,markers) of hom calls of the first and second allele found in a file
+            for every marker, recoded to the alleles already known. Markers with no known alleles
+            take the alleles as found.
+        """
+        codes = np.zeros((2,len(icols)))
+        codes[0],codes[1] = -1,1
+        if self.ia == 1: return codes
+        new = self.alleles[2][icols] == 0
+        for i,col in enumerate(icols):
+            if not new[i]: continue
+            for k,allele in enumerate(found[i]): self.alleles[k][col] = ord(allele)
+            self.alleles[2][col] = len(found[i])
+        for k in [0,1]:
+            sel = np.array([not new[i] and len(found[i]) > k for i in range(len(icols))],dtype=bool)
+            if not sel.any(): continue
+            x = np.array([ord(found[i][k]) for i in np.nonzero(sel)[0]],dtype=np.int32)
+            codes[k,sel] = libSNP.codeAlleles(x,x,icols[sel],self.alleles,self.marklist)
+        return codes
+
+    def readPlink(self,bedfile,ped):
+        """
+            Fills in the rows of the samples in a binary PLINK fileset
+            The .bed file is memory-mapped and decoded a block of markers at a time,
+            A1/A2 from the .bim file are recoded to the alleles already known for each marker
+        """
+        bim = libSNP.readBim(bedfile)
+        irows = np.array([ped[l[1]]['rank'] for l in libSNP.readFam(bedfile)],dtype=int)
+        bed = libSNP.BedFile(bedfile,len(irows),len(bim))
+        # Positions of the known markers, the last one if a marker is listed more than once
+        last = dict((l[1],i) for i,l in enumerate(bim) if l[1] in self.mark)
+        pos = np.array(sorted(last.values()),dtype=int)
+        icols = np.array([self.mark[bim[i][1]]['rank'] for i in pos],dtype=int)
+        # Alleles longer than one character are replaced by their position in the .bim file
+        found = []
+        for i in pos:
+            a1,a2 = [a if len(a) == 1 else str(k+1) for k,a in enumerate(bim[i][4:6])]
+            found.append([a for a in [a1,a2] if a != '0'])
+        codes = self.alleleCodes(icols,found)
+        # A1 missing in the .bim file means only A2 is found, its code is then the first one
+        hom1 = np.where([bim[i][4] != '0' for i in pos],codes[0],np.nan)
+        hom2 = np.where([bim[i][4] != '0' for i in pos],codes[1],codes[0])
+        # Markers per block, keeping the decoded block at a few million calls
+        step = max(64,(1 << 22)//max(len(irows),1))
+        for start in range(0,len(pos),step):
+            raw = bed.codes(pos[start:start+step])
+            h1,h2 = hom1[start:start+step],hom2[start:start+step]
+            vals = np.where(raw == libSNP.BED_HOM1,h1,np.where(raw == libSNP.BED_HOM2,h2,0.0))
+            vals[raw == libSNP.BED_MISSING] = np.nan
+            self.setGenoBlock(irows,icols[start:start+step],vals)
+
+    def newGenos(self,nrows):
+        # Allocates the genotype store with every call missing
+        nmark = len(self.mark)
+        if self.store == 'packed': shape,dtype = (nrows,2,(nmark+63)//64),np.uint64
+        elif self.store == 'int8': shape,dtype = (nrows,nmark),np.int8
+        else: shape,dtype = (nrows,nmark),np.float64
+        if self.memlimit:
+            # Disk-backed store, only the marker chunks in use are read into memory
+            fd,path = tempfile.mkstemp(prefix='pedcheck',suffix='.gen')
+            os.close(fd)
+            self.gen = np.memmap(path,dtype=dtype,mode='w+',shape=shape)
+            os.remove(path) # The mapping stays valid until the process exits
+        else:
+            self.gen = np.zeros(shape,dtype=dtype)
+        if self.store == 'packed':
+            self.allsites = packGenos(np.zeros(nmark))[0] # Bit set for every marker
+        else:
+            for start in range(0,nrows,self.blocksize): self.clearGenos(slice(start,start+self.blocksize))
+
+    def clearGenos(self,irows):
+        # Sets every call of the given rows to missing
+        if self.store == 'packed': self.gen[irows] = 0
+        elif self.store == 'int8': self.gen[irows] = libSNP.MISSING
+        else: self.gen[irows] = np.nan
+
+    def resizeGenos(self,nrows):
+        # Changes the number of rows of the genotype store, added rows are missing
+        old = len(self.gen)
+        if nrows == old: return
+        if isinstance(self.gen,np.memmap):
+            gen = self.gen
+            self.newGenos(nrows)
+            for start in range(0,min(old,nrows),self.blocksize):
+                end = min(start+self.blocksize,old,nrows)
+                self.gen[start:end] = gen[start:end]
+            return
+        self.gen.resize((nrows,)+self.gen.shape[1:],refcheck=False)
+        if nrows > old: self.clearGenos(slice(old,nrows))
+
+    def setGenos(self,irow,icols,vals):
+        # Stores genotypes coded as -1/0/1 (nan for missing) for the given columns of one row, converted to the store
+        if self.store == 'packed':
+            row = unpackGenos(self.gen[irow],len(self.mark))
+            row[icols] = vals
+            self.gen[irow] = packGenos(row)
+        elif self.store == 'int8':
+            self.gen[irow,icols] = libSNP.toInt8(np.asarray(vals,dtype=np.float64))
+        else:
+            self.gen[irow,icols] = vals
+
+    def setGenoBlock(self,irows,icols,vals):
+        # Same as setGenos, for a block of rows
+        if self.store == 'packed':
+            # Sets the bits of the columns one 64-bit word at a time
+            called = ~np.isnan(vals)
+            planes = [called & (np.nan_to_num(vals) <= 0),called & (np.nan_to_num(vals) >= 0)]
+            words = icols//64
+            bits = np.left_shift(np.uint64(1),(icols % 64).astype(np.uint64))
+            for w in np.unique(words):
+                sel = words == w
+                mask = np.bitwise_or.reduce(bits[sel])
+                for k,plane in enumerate(planes):
+                    new = np.bitwise_or.reduce(np.where(plane[:,sel],bits[sel],np.uint64(0)),axis=1)
+                    self.gen[irows,k,w] = (self.gen[irows,k,w] & ~mask) | new
+        elif self.store == 'int8':
+            self.gen[np.ix_(irows,icols)] = libSNP.toInt8(vals)
+        else:
+            self.gen[np.ix_(irows,icols)] = vals
+
+    def splitPacked(self,irow):
+        """ Returns hom-ref, hom-alt, het and called bit masks for one packed row """
+        lo,hi = self.gen[irow,0],self.gen[irow,1]
+        return lo & ~hi, hi & ~lo, lo & hi, lo | hi
+
+    def indicators(self,irows,dtype=np.float32,cols=None):
+        """
+            Returns hom-ref, hom-alt and called indicator matrices for the given rows, and columns if given
+            cols is either a list of columns or a slice, packed slices have to start on a multiple of 64
+        """
+        if self.store == 'packed':
+            if isinstance(cols,slice):
+                words = slice(cols.start//64,(cols.stop+63)//64)
+                return packedIndicators(self.gen[irows,:,words],cols.stop-cols.start,dtype)
+            ind = packedIndicators(self.gen[irows],len(self.mark),dtype)
+            if cols is None: return ind
+            return tuple(m[:,cols] for m in ind)
+        if cols is None: return indicators(self.gen[irows],dtype)
+        if isinstance(cols,slice): return indicators(self.gen[irows,cols],dtype)
+        return indicators(self.gen[np.ix_(irows,cols)],dtype)
+
+    def markerChunks(self,outbytes=0):
+        """
+            Returns the column ranges processed together by the block searches, all markers at once
+            unless a memory limit is set. A chunk holds two blocks of rows, as genotypes and as
+            three float32 indicator matrices, in what is left of the limit after the outbytes of
+            the count matrices of the block.
+        """
+        nmark = len(self.mark)
+        if not self.memlimit: return [slice(0,nmark)]
+        width = max(0,self.memlimit-outbytes) // (2*self.blocksize*(8+3*4))
+        width = max(64,width - width % 64)
+        return [slice(start,min(start+width,nmark)) for start in range(0,nmark,width)]
+
+    def rowBlock(self,ncols,nmat=3):
+        """
+            Returns the samples per block scored against ncols animals. With a memory limit the block
+            is made smaller so that its nmat count matrices (int64 or float64) take at most half of it.
+        """
+        if not self.memlimit: return self.blocksize
+        return int(max(1,min(self.blocksize,self.memlimit // (2*8*nmat*max(ncols,1)))))
 
     def readPedigree(self,pedfile,count=0,real=True):
         """
@@ -139,31 +711,56 @@ class SNP(object):
             present or just the father, respectively.
         count is the starting position for the first sample, use when reading from more than one file
         """
+        if not real and libSNP.isPlink(pedfile):
+            lines = [['0']*self.nc+l[1:4] for l in libSNP.readFam(pedfile)]
+        elif not real and self.cache:
+            lines = [['0']*self.nc+l for l in self.cacheEntry(pedfile)['pedigree']]
+        else:
+            lines = self.splitLines(pedfile)
+        return self.pedigreeLines(lines,count,real)
+
+    def pedigreeLines(self,lines,count=0,real=True):
+        # The pedigree of readPedigree from split lines
         ped = {}
         pedlist = []
-        with open(pedfile,'r') as fin:
-            for line in fin:
-                if line.startswith('#'): continue
-                l = line.strip().split()
-                name,father,mother,family,sex = '0','0','0','0','3'
-                if len(l) > 0: name = l[self.nc]
-                if (real or self.ic > 1) and len(l) > 1: father = l[self.nc+1]
-                if (real or self.ic > 2) and len(l) > 2: mother = l[self.nc+2]
-                if real and len(l) > 4: family,sex = l[3],l[4]
-                if name == '0': continue
-                if name not in ped:
-                    ped[name] = {'father':father,
-                                 'mother':mother,
-                                 'rank':count,
-                                 'sex':sex,
-                                 'children':[]}
-                    count += 1
-                    pedlist.append(name)
-                else:
-                    sys.stderr.write('%s present more than once\n' % name)
+        for l in lines:
+            name,entry = self.pedEntry(l,count,real)
+            if name == '0': continue
+            if name not in ped:
+                ped[name] = entry
+                count += 1
+                pedlist.append(name)
+            else:
+                sys.stderr.write('%s present more than once\n' % name)
         self.updatePed(ped)
         return ped,pedlist
 
+    def pedEntry(self,l,rank,real=True):
+        # Returns the name and pedigree information of one split line, see readPedigree
+        name,father,mother,family,sex = '0','0','0','0','3'
+        if len(l) > 0: name = l[self.nc]
+        if (real or self.ic > 1) and len(l) > 1: father = l[self.nc+1]
+        if (real or self.ic > 2) and len(l) > 2: mother = l[self.nc+2]
+        if real and len(l) > 4: family,sex = l[3],l[4]
+        born = np.nan
+        if real and self.birthcol and len(l) >= self.birthcol:
+            try: born = float(l[self.birthcol-1])
+            except ValueError: pass
+            if born == 0: born = np.nan
+        return name,{'father':father,
+                     'mother':mother,
+                     'rank':rank,
+                     'sex':sex,
+                     'born':born,
+                     'children':[]}
+
+    def splitLines(self,infile):
+        # Yields the split lines of a file, skipping comments
+        with libSNP.openFile(infile) as fin:
+            for line in fin:
+                if line.startswith('#'): continue
+                yield line.strip().split()
+
     def collectPedigree(self,pedfile,file1,file2):
         """
         Reads a pedigree and lists of the animals in each file
@@ -177,7 +774,8 @@ class SNP(object):
         else:
             self.ped,self.pedlist = self.readPedigree(file1,0,False)
             self.ped1,self.names1 = self.ped,self.pedlist
-        if file2: self.ped2,self.names2 = self.readPedigree(file2,len(self.ped1),False)
+        if file2 and self.stream: self.ped2,self.names2 = {},[] # Read a batch at a time by findParentStream
+        elif file2: self.ped2,self.names2 = self.readPedigree(file2,len(self.ped1),False)
         else: self.ped2,self.names2 = self.ped1,self.names1
 
 
@@ -200,7 +798,7 @@ class SNP(object):
         """
         self.mark = {}
         self.marklist = []
-        with open(markerfile,'r') as fin:
+        with libSNP.openFile(markerfile) as fin:
             count = 0
             for line in fin:
                 if line.startswith('#'): continue
@@ -227,19 +825,23 @@ class SNP(object):
             If the markers are not present as a comment line on top of the file,
             it will calculate the number of markers to be the same as the number of alleles
             after the information columns.
+            For a binary Plink fileset the markers are taken from the .bim file.
         """
         self.mark = {}
         self.marklist = []
-        with open(ingeno,'r') as fin:
+        if libSNP.isPlink(ingeno):
+            for i,l in enumerate(libSNP.readBim(ingeno)):
+                if l[1] in self.mark: continue
+                self.mark[l[1]] = {'chrom':l[0],
+                                   'pos':int(l[3]),
+                                   'alleles': [],
+                                   'rank':len(self.marklist)}
+                self.marklist.append(l[1])
+            return
+        with libSNP.openFile(ingeno) as fin:
             for line in fin:
                 if line.startswith('#'):
-                    l = line.strip('#').strip().split()
-                    for i,e in enumerate(l):
-                        self.mark[e] = {'chrom':'0',
-                                       'pos':i,
-                                       'alleles': [],
-                                       'rank':i}
-                        self.marklist.append(e)
+                    self.headerMarkers(line.strip('#').strip().split())
                     break
             else:
                 l = line.strip().split()
@@ -258,6 +860,15 @@ class SNP(object):
                                            'rank':i}
                         self.marklist.append(str(i))
 
+    def headerMarkers(self,mlist):
+        # Takes the markers from the header line of a genotype file
+        for i,e in enumerate(mlist):
+            self.mark[e] = {'chrom':'0',
+                           'pos':i,
+                           'alleles': [],
+                           'rank':i}
+            self.marklist.append(e)
+
 #*****************************************************************************************************
 
     def findDiscords(self,anim,father,mother,limit=100):
@@ -265,17 +876,20 @@ class SNP(object):
             Detects all mendelian discords within the given trio
             Will work even if one of the parents is missing
         """
+        if self.store == 'packed': return self.findDiscordsPacked(anim,father,mother,limit)
         results = {}
         if self.verbose: sys.stdout.write('Checking: %s vs. %s and %s' % (anim,father,mother))
+        # Sites where each comparison is informative, all sites when a comparison is not made
+        okF = okM = okT = np.ones(len(self.mark),dtype=bool)
+        wrongF = wrongM = wrongT = np.zeros(len(self.mark),dtype=bool)
         # Father
         try:
-            resF = self.gen[self.ped2[father]['rank'],:]*self.gen[self.ped1[anim]['rank'],:]
-            wrongF = resF==-1
-            sitesF = len(resF) - np.count_nonzero(np.isnan(resF))
+            gF,gA = self.gen[self.ped2[father]['rank'],:],self.gen[self.ped1[anim]['rank'],:]
+            okF = libSNP.called(gF) & libSNP.called(gA)
+            wrongF = (gF*gA == -1) & okF
+            sitesF = np.count_nonzero(okF)
         except KeyError:
-            wrongF = [False]*len(self.mark)
             sitesF = 0
-            resF = wrongF
         if sitesF == 0:
             pct = -1
         else:
@@ -284,78 +898,98 @@ class SNP(object):
         results[father] = {'disc':np.count_nonzero(wrongF),'sites':sitesF,'pct':pct}
         # Mother
         try:
-            resM = self.gen[self.ped2[mother]['rank'],:]*self.gen[self.ped1[anim]['rank'],:]
-            wrongM = resM==-1
-            sitesM = len(resM) - np.count_nonzero(np.isnan(resM))
+            gM,gA = self.gen[self.ped2[mother]['rank'],:],self.gen[self.ped1[anim]['rank'],:]
+            okM = libSNP.called(gM) & libSNP.called(gA)
+            wrongM = (gM*gA == -1) & okM
+            sitesM = np.count_nonzero(okM)
         except KeyError:
-            wrongM = [False]*len(self.mark)
             sitesM = 0
-            resM = wrongM
         if sitesM == 0:
             pct = -1
         else:
             pct = 100*np.count_nonzero(wrongM) / sitesM
         if self.verbose: sys.stdout.write(' %.3f' % pct)
         results[mother] = {'disc':np.count_nonzero(wrongM),'sites':sitesM,'pct':pct}
-        # Trios
+        # Trios, parents homozygous for the same allele and a heterozygous offspring
         try:
-            resT = self.gen[self.ped2[father]['rank'],:]*self.gen[self.ped2[mother]['rank'],:] -\
-                   (self.gen[self.ped1[anim]['rank'],:]*self.gen[self.ped1[anim]['rank'],:])
-            wrongT = resT==1
-            sitesT = len(resT) - np.count_nonzero(np.isnan(resT))
+            gF,gM,gA = self.gen[self.ped2[father]['rank'],:],self.gen[self.ped2[mother]['rank'],:],self.gen[self.ped1[anim]['rank'],:]
+            okT = libSNP.called(gF) & libSNP.called(gM) & libSNP.called(gA)
+            wrongT = (gF*gM == 1) & (gA == 0) & okT
         except KeyError:
-            wrongT = [False]*len(self.mark)
-            sitesT = 0
-            resT = wrongT
-        wrongTrio = np.logical_or(np.logical_or(wrongF,wrongM),wrongT)
-        wrongSites = np.logical_or(np.logical_or(np.isnan(resF),np.isnan(resM)),np.isnan(resT))
-        if len(resT)-np.count_nonzero(wrongSites) == 0:
+            pass
+        wrongTrio = wrongF | wrongM | wrongT
+        sitesT = np.count_nonzero(okF & okM & okT)
+        if sitesT == 0:
             pct = -1
         else:
-            pct = 100*np.count_nonzero(wrongTrio) / (len(resT)-np.count_nonzero(wrongSites))
+            pct = 100*np.count_nonzero(wrongTrio) / sitesT
         if self.verbose: sys.stdout.write(' %.3f\n' % pct)
         if pct > limit or pct < 0: return None
-        results[father,mother] = {'disc':np.count_nonzero(wrongTrio),'sites':len(resT)-np.count_nonzero(wrongSites),'pct':pct}
+        results[father,mother] = {'disc':np.count_nonzero(wrongTrio),'sites':sitesT,'pct':pct}
         return results
 
     def checkPed(self,outfile):
-        # Checks the provided pedigree for discords
-        if outfile: fout = open(outfile,'w')
-        else: fout = sys.stdout
-        for sample in self.pedlist:
-            father = self.ped[sample]['father']
-            mother = self.ped[sample]['mother']
-            if father != '0' or mother != '0':
-                res = self.findDiscords(sample,father,mother)
-                if not res:
+        """
+            Checks the provided pedigree for discords
+            The row indices of every trio are collected first, then blocks of trios are
+            scored together, giving the same results as findDiscords for each animal
+        """
+        fout = self.openReport(outfile)
+        for start in range(0,len(self.pedlist),self.blocksize):
+            block = self.pedlist[start:start+self.blocksize]
+            rows = np.zeros((3,len(block)),dtype=int)
+            found = np.zeros((3,len(block)),dtype=bool)
+            for i,sample in enumerate(block):
+                for j,(anim,ped) in enumerate([(sample,self.ped1),
+                                               (self.ped[sample]['father'],self.ped2),
+                                               (self.ped[sample]['mother'],self.ped2)]):
+                    if anim in ped: rows[j,i],found[j,i] = ped[anim]['rank'],True
+            counts = 0
+            for cols in self.markerChunks():
+                counts = counts + np.array(trioCounts(self.indicators(rows[0],bool,cols),
+                                                      self.indicators(rows[1],bool,cols),
+                                                      self.indicators(rows[2],bool,cols),
+                                                      found[0] & found[1],found[0] & found[2]))
+            for i,sample in enumerate(block):
+                father = self.ped[sample]['father']
+                mother = self.ped[sample]['mother']
+                f1,f2,m1,m2,t1,t2 = [int(c[i]) for c in counts]
+                if (father == '0' and mother == '0') or t2 == 0:
                     f1 = f2 = m1 = m2 = t1 = t2 = 0
                     f3 = m3 = t3 = -1
                 else:
-                    f1,f2,f3 = res[father]['disc'],res[father]['sites'],res[father]['pct']
-                    m1,m2,m3 = res[mother]['disc'],res[mother]['sites'],res[mother]['pct']
-                    t1,t2,t3 = res[father,mother]['disc'],res[father,mother]['sites'],res[father,mother]['pct']
-            else:
-                f1 = f2 = m1 = m2 = t1 = t2 = 0
-                f3 = m3 = t3 = -1 
-            fout.write('%s\t%s\t%d\t%d\t%.2f\t%s\t%d\t%d\t%.2f\t%d\t%d\t%.2f\n' % (sample,father,f1,f2,f3,mother,m1,m2,m3,t1,t2,t3))
-        if outfile: fout.close()
+                    f3,m3,t3 = [100*d / n if n > 0 else -1 for d,n in [(f1,f2),(m1,m2),(t1,t2)]]
+                fout.write('%s\t%s\t%d\t%d\t%.2f\t%s\t%d\t%d\t%.2f\t%d\t%d\t%.2f\n' % (sample,father,f1,f2,f3,mother,m1,m2,m3,t1,t2,t3))
+        self.closeReport(fout,outfile)
+
+    def openReport(self,outfile):
+        # The report is written to stdout when outfile is None, outfile may also be an open file
+        if not outfile: return sys.stdout
+        if hasattr(outfile,'write'): return outfile
+        return open(outfile,'w')
+
+    def closeReport(self,fout,outfile):
+        # Closes the report if openReport opened it
+        if outfile and not hasattr(outfile,'write'): fout.close()
 
     def findSingleDiscords(self,anim,father,limit):
         """
             Detects all mendelian discords within the given trio
             Will work even if one of the parents is missing
         """
+        if self.earlyexit: return self.findSingleDiscordsEarly(anim,father,limit)
+        if self.store == 'packed': return self.findSingleDiscordsPacked(anim,father,limit)
         if self.verbose: sys.stdout.write('Checking: %s vs. %s ' % (anim,father))
         results = {}
         # Father
         try:
-            resF = self.gen[self.ped2[father]['rank'],:]*self.gen[self.ped1[anim]['rank'],:]
-            wrongF = resF==-1
-            sitesF = len(resF) - np.count_nonzero(np.isnan(resF))
+            gF,gA = self.gen[self.ped2[father]['rank'],:],self.gen[self.ped1[anim]['rank'],:]
+            okF = libSNP.called(gF) & libSNP.called(gA)
+            wrongF = (gF*gA == -1) & okF
+            sitesF = np.count_nonzero(okF)
         except KeyError:
-            wrongF = [False]*len(self.mark)
+            wrongF = []
             sitesF = 0
-            resF = wrongF
         if sitesF == 0:
             pct = -1
         else:
@@ -365,57 +999,598 @@ class SNP(object):
         results = {'disc':np.count_nonzero(wrongF),'sites':sitesF,'pct':pct}
         return results
 
+    def findSingleDiscordsEarly(self,anim,father,limit):
+        """
+            Same as findSingleDiscords, counting the markers in steps (exitstep markers, doubling)
+            and stopping as soon as the pair would stay over the limit even if every remaining marker was informative and
+            without discords. Pairs that are not stopped get the same numbers as the full count.
+        """
+        if self.verbose: sys.stdout.write('Checking: %s vs. %s ' % (anim,father))
+        nmark = len(self.mark)
+        disc = sites = 0
+        if anim in self.ped1 and father in self.ped2:
+            irow,prow = self.ped1[anim]['rank'],self.ped2[father]['rank']
+            self.exitstats['pairs'] += 1
+            self.exitstats['markers'] += nmark
+            start,step = 0,self.exitstep
+            while start < nmark:
+                scanned = min(start+step,nmark)
+                d,n = self.rangeCounts(irow,prow,start,scanned)
+                start = scanned
+                disc += d
+                sites += n
+                # Next step: where the discords found so far would reach the limit, at least doubling
+                # the markers seen when there are none yet, so a pair costs a few tests at most
+                need = limit*nmark / 100.0
+                if disc > 0: step = max(self.exitstep,int(need*scanned / disc)-scanned+self.exitstep)
+                else: step = 2*scanned
+                step += -step % 64 # Packed rows are counted in whole words, steps must not split them
+                if scanned < nmark and disc > 0 and 100*disc / (sites+nmark-scanned) > limit:
+                    self.exitstats['scanned'] += scanned
+                    self.exitstats['stopped'] += 1
+                    if self.verbose: sys.stdout.write('stopped after %d markers\n' % scanned)
+                    return None
+            self.exitstats['scanned'] += nmark
+        if sites == 0:
+            pct = -1
+        else:
+            pct = 100*disc / sites
+        if self.verbose: sys.stdout.write('%d\n' % pct)
+        if pct > limit or pct < 0: return None
+        return {'disc':disc,'sites':sites,'pct':pct}
+
+    def rangeCounts(self,irow,prow,start,end):
+        """ Returns opposite homozygotes and informative sites between two rows on markers start to end """
+        if self.store == 'packed':
+            words = slice(start//64,(end+63)//64)
+            loA,hiA = self.gen[irow,0,words],self.gen[irow,1,words]
+            loF,hiF = self.gen[prow,0,words],self.gen[prow,1,words]
+            disc = popcount((loF & ~hiF & hiA & ~loA) | (hiF & ~loF & loA & ~hiA))
+            return disc,popcount((loF | hiF) & (loA | hiA))
+        gF,gA = self.gen[prow,start:end],self.gen[irow,start:end]
+        ok = libSNP.called(gF) & libSNP.called(gA)
+        return np.count_nonzero((gF*gA == -1) & ok),np.count_nonzero(ok)
+
+    def reportEarlyExit(self):
+        # Writes how much of the pair counting was skipped by the early exits
+        stats = self.exitstats
+        if stats['pairs'] == 0: return
+        skipped = 100.0*(stats['markers']-stats['scanned']) / max(stats['markers'],1)
+        sys.stderr.write('Early exit: %d of %d pairs stopped early, %d of %d markers scanned (%.1f%% skipped)\n' % (stats['stopped'],stats['pairs'],stats['scanned'],stats['markers'],skipped))
+
     def findParent(self,outfile,limit):
-        if outfile: fout = open(outfile,'w')
-        else: fout = sys.stdout
-        # Checks the provided pedigree for potential parents
-        for sample in self.pedlist:
-            for parent in self.ped2:
-                if sample == parent: continue
-                temp  = self.findSingleDiscords(sample,parent,limit)
-                if not temp: continue
-                f1,f2,f3 = temp['disc'],temp['sites'],temp['pct']
-                fout.write('%s\t%s\t%d\t%d\t%.2f\n' % (sample,parent,f1,f2,f3))
-        if outfile: fout.close()
+        """
+            Checks the provided pedigree for potential parents
+            Blocks of samples are scored against blocks of reference animals with
+            matrix products, the output is the same as calling findSingleDiscords
+            for every pair
+        """
+        fout = self.openReport(outfile)
+        samples = [sample for sample in self.pedlist if sample in self.ped1]
+        if self.streamfile:
+            self.findParentStream(fout,samples,limit)
+            if self.earlyexit: self.reportEarlyExit()
+            self.closeReport(fout,outfile)
+            return
+        if self.results:
+            if self.prune: self.buildPruneIndex(samples)
+            self.findParentIncremental(fout,samples,limit)
+            self.closeReport(fout,outfile)
+            return
+        if self.prune: self.buildPruneIndex(samples)
+        if self.screen: self.screenPairs(samples,limit)
+        found = self.runShards(fout,'findParentShard',self.shards(samples),limit)
+        if self.screen: self.reportScreen(found)
+        if self.earlyexit: self.reportEarlyExit()
+        self.closeReport(fout,outfile)
+
+    def findParentStream(self,fout,samples,limit):
+        """
+            Same as findParent, for a reference file read in batches by streamBatches
+            Every batch is scored against all samples and written before the next one is read,
+            the output follows the batches in file order. With topk the best parents are kept
+            over all batches and written at the end.
+        """
+        nref = nbatch = 0
+        parents = [] # Names of the reference samples, only kept with topk
+        heaps = [[] for sample in samples]
+        for batch in self.streamBatches(self.streamfile):
+            self.ped2 = batch
+            if self.topk:
+                prows = np.array([batch[parent]['rank'] for parent in batch],dtype=int)
+                offset = len(parents)
+                parents += list(batch)
+                step = self.rowBlock(len(prows))
+                for start in range(0,len(samples),step):
+                    block = samples[start:start+step]
+                    disc,sites = self.parentCounts([self.ped1[sample]['rank'] for sample in block],prows,limit)
+                    for i,sample in enumerate(block):
+                        self.pushParents(heaps[start+i],sample,parents,offset,disc[i],sites[i],limit)
+            else:
+                self.runShards(fout,'findParentShard',self.shards(samples),limit)
+            nref += len(batch)
+            nbatch += 1
+            if self.verbose: sys.stdout.write('Reference batch %d: %d samples\n' % (nbatch,len(batch)))
+        if self.topk:
+            for i,sample in enumerate(samples): self.writeTop(fout,sample,parents,heaps[i])
+        sys.stderr.write('Stream: %d reference samples in %d batches of at most %d\n' % (nref,nbatch,self.stream))
+
+    def findParentShard(self,fout,samples,limit):
+        # Writes the potential parents for a list of samples, returns the number of pairs written
+        parents = list(self.ped2)
+        if self.candidates is not None:
+            # Second stage of the screen, the parents that passed are checked on all markers
+            found = 0
+            for sample in samples:
+                heap = []
+                for i in self.candidates[sample]:
+                    temp = self.findSingleDiscords(sample,parents[i],limit)
+                    if not temp: continue
+                    if self.topk:
+                        pushTop(heap,self.topk,temp['pct'],temp['sites'],i,temp['disc'])
+                        continue
+                    fout.write('%s\t%s\t%d\t%d\t%.2f\n' % (sample,parents[i],temp['disc'],temp['sites'],temp['pct']))
+                    found += 1
+                found += self.writeTop(fout,sample,parents,heap)
+            return found
+        found = 0
+        prows = np.array([self.ped2[parent]['rank'] for parent in parents],dtype=int)
+        if self.topk:
+            # Blocks of parents are scored in turn, only the best parents of every sample are kept
+            for start in range(0,len(samples),self.blocksize):
+                block = samples[start:start+self.blocksize]
+                if self.verbose: sys.stdout.write('Checking: %s to %s vs. %d animals\n' % (block[0],block[-1],len(parents)))
+                rows1 = [self.ped1[sample]['rank'] for sample in block]
+                heaps = [[] for sample in block]
+                # The indicators of the samples are built once for all parent blocks, unless they
+                # are split in marker chunks to stay within the memory limit
+                ind1 = None
+                if len(self.markerChunks(2*8*len(block)*self.blocksize)) == 1: ind1 = self.indicators(rows1)
+                for pstart in range(0,len(parents),self.blocksize):
+                    disc,sites = self.prunedCounts(block,rows1,prows[pstart:pstart+self.blocksize],limit,pstart,ind1)
+                    for i,sample in enumerate(block):
+                        self.pushParents(heaps[i],sample,parents,pstart,disc[i],sites[i],limit)
+                for i,sample in enumerate(block):
+                    found += self.writeTop(fout,sample,parents,heaps[i])
+            return found
+        step = self.rowBlock(len(parents))
+        for start in range(0,len(samples),step):
+            block = samples[start:start+step]
+            if self.verbose: sys.stdout.write('Checking: %s to %s vs. %d animals\n' % (block[0],block[-1],len(parents)))
+            disc,sites = self.prunedCounts(block,[self.ped1[sample]['rank'] for sample in block],prows,limit)
+            for i,sample in enumerate(block):
+                found += self.writeParents(fout,sample,parents,disc[i],sites[i],limit)
+        return found
+
+    def pushParents(self,heap,sample,parents,offset,disc,sites,limit):
+        """
+            Adds the parents within the limit from one block of parents (starting at offset) to the
+            heap of best parents of a sample. At most topk of them, selected with numpy, reach the heap.
+        """
+        with np.errstate(divide='ignore',invalid='ignore'):
+            pct = 100*disc / sites
+        idx = np.array([j for j in np.nonzero((sites > 0) & (pct <= limit))[0] if parents[offset+j] != sample],dtype=int)
+        if len(idx) > self.topk: idx = idx[np.lexsort((idx,-sites[idx],pct[idx]))[:self.topk]]
+        for j in idx: pushTop(heap,self.topk,pct[j],sites[j],offset+j,disc[j])
+
+    def writeTop(self,fout,sample,parents,heap):
+        # Writes the parents kept in the heap of a sample, best first, returns the number written
+        for pct,sites,j,disc in sorted(heap,reverse=True):
+            fout.write('%s\t%s\t%d\t%d\t%.2f\n' % (sample,parents[-j],disc,sites,-pct))
+        return len(heap)
+
+    def buildPruneIndex(self,samples):
+        """
+            Builds the index used to skip impossible parents before any genotypes are compared
+            A sample can not have its own descendants in the pedigree as parents, and with birth
+            years a parent must be at least minage years older. The recorded parents of a sample are
+            not used to rule out anything, they are the links the search is meant to question.
+            Writes the number of candidate pairs left for the samples, counted from the descendants
+            and the sorted birth years without building the masks.
+        """
+        ped = self.ped
+        parents = list(self.ped2)
+        born = np.array([ped[parent]['born'] if parent in ped else np.nan for parent in parents])
+        self.pruneindex = {'born':born,'index':dict((parent,j) for j,parent in enumerate(parents)),'desc':{}}
+        known = np.sort(born[~np.isnan(born)])
+        kept = 0
+        for sample in samples:
+            desc = self.pruneDescendants(sample)
+            pruned = len(desc)
+            b = ped[sample]['born'] if sample in ped else np.nan
+            if not np.isnan(b):
+                # Parents born too late, and the descendants not already among them
+                with np.errstate(invalid='ignore'):
+                    pruned = len(known)-np.searchsorted(known,b-self.minage,side='right') + int(np.count_nonzero(~(b - born[desc] < self.minage)))
+            kept += len(parents)-pruned
+        total = len(samples)*len(parents) - len([sample for sample in samples if sample in self.ped2])
+        pruned = 0.0
+        if total > 0: pruned = 100.0*(total-kept) / total
+        sys.stderr.write('Pruning: %d of %d candidate pairs kept, %.1f%% pruned by the pedigree\n' % (kept,total,pruned))
+
+    def pruneDescendants(self,sample):
+        """
+            Positions in self.ped2 of a sample and its descendants, sorted
+            Found once per animal, merged from the positions of its children. Wrong parents can make
+            loops in the pedigree, the animals of a loop (a strongly connected component, found by
+            Tarjan's algorithm) all have the same descendants.
+        """
+        index = self.pruneindex
+        desc = index['desc']
+        if sample in desc: return desc[sample]
+        def children(anim):
+            if anim not in self.ped: return []
+            return [child for child in self.ped[anim]['children'] if child not in desc]
+        order,low = {sample:0},{sample:0}
+        stack,path,onpath = [(sample,iter(children(sample)))],[sample],set([sample])
+        while stack:
+            anim,todo = stack[-1]
+            for child in todo:
+                if child not in order:
+                    order[child] = low[child] = len(order)
+                    path.append(child)
+                    onpath.add(child)
+                    stack.append((child,iter(children(child))))
+                    break
+                if child in onpath: low[anim] = min(low[anim],order[child])
+            else:
+                stack.pop()
+                if stack: low[stack[-1][0]] = min(low[stack[-1][0]],low[anim])
+                if low[anim] < order[anim]: continue
+                # anim and the animals after it on the path make up a component, every child outside it is done
+                members = path[path.index(anim):]
+                del path[len(path)-len(members):]
+                onpath.difference_update(members)
+                found = [np.array([index['index'][m] for m in members if m in index['index']],dtype=int)]
+                for m in members:
+                    if m in self.ped: found += [desc[child] for child in self.ped[m]['children'] if child in desc]
+                found = np.unique(np.concatenate(found))
+                for m in members: desc[m] = found
+        return desc[sample]
+
+    def pruneMask(self,sample,start=0,end=None):
+        # Returns which of the potential parents (in self.ped2 order, from start to end) the pruning index allows for a sample
+        index = self.pruneindex
+        if end is None: end = len(index['born'])
+        allowed = np.ones(end-start,dtype=bool)
+        born = np.nan
+        if sample in self.ped: born = self.ped[sample]['born']
+        if not np.isnan(born):
+            with np.errstate(invalid='ignore'):
+                allowed &= ~(born - index['born'][start:end] < self.minage)
+        desc = self.pruneDescendants(sample)
+        allowed[desc[np.searchsorted(desc,start):np.searchsorted(desc,end)]-start] = False
+        return allowed
+
+    def prunedCounts(self,block,rows1,prows,limit,offset=0,ind1=None):
+        """
+            parentCounts for a block of samples and the potential parents starting at offset in self.ped2,
+            without scoring the pairs ruled out by the pruning index. The samples are grouped by birth year,
+            every group is only scored against the parents allowed for at least one of its samples.
+            Pruned pairs get no sites.
+        """
+        if self.pruneindex is None: return self.parentCounts(rows1,prows,limit,ind1)
+        allowed = np.array([self.pruneMask(sample,offset,offset+len(prows)) for sample in block])
+        born = np.array([self.ped[sample]['born'] if sample in self.ped else np.nan for sample in block])
+        order = np.argsort(born,kind='mergesort')
+        # Samples born the same year stay together, smaller groups are joined up to prunegroup samples
+        years = np.where(np.isnan(born),np.inf,born)[order]
+        bounds = [0]
+        for start in np.nonzero(years[1:] != years[:-1])[0]+1:
+            if start-bounds[-1] >= self.prunegroup: bounds.append(start)
+        disc = np.zeros(allowed.shape,dtype=np.int64)
+        sites = np.zeros(allowed.shape,dtype=np.int64)
+        for start,end in zip(bounds,bounds[1:]+[len(order)]):
+            group = order[start:end]
+            cols = np.nonzero(allowed[group].any(axis=0))[0]
+            if len(cols) == 0: continue
+            ind = None
+            if ind1 is not None: ind = tuple(m[group] for m in ind1)
+            d,n = self.parentCounts([rows1[i] for i in group],prows[cols],limit,ind)
+            disc[np.ix_(group,cols)] = d
+            sites[np.ix_(group,cols)] = n
+        sites[~allowed] = 0
+        return disc,sites
+
+    def findParentIncremental(self,fout,samples,limit):
+        """
+            Same output as findParent, reusing the pair counts stored by an earlier run
+            Only new samples against all parents, and old samples against new parents, are scored.
+            Animals whose genotypes changed count as new. Everything is scored again if the markers
+            changed or the stored results used a lower noise level.
+        """
+        parents = list(self.ped2)
+        srows = np.array([self.ped1[sample]['rank'] for sample in samples],dtype=int)
+        prows = np.array([self.ped2[parent]['rank'] for parent in parents],dtype=int)
+        sdigest,pdigest = self.rowDigests(srows),self.rowDigests(prows)
+        markers = hashlib.sha1('\t'.join(self.marklist).encode('utf-8')).hexdigest()
+        old = self.results.load()
+        if old is not None and (old['markers'] != markers or old['limit'] < limit): old = None
+        oldS,oldP = {},{}
+        if old is not None:
+            oldS = dict((name,i) for i,name in enumerate(old['samples']) if name in self.ped1)
+            oldP = dict((name,i) for i,name in enumerate(old['parents']) if name in self.ped2)
+        keptS = np.array([sample in oldS and old['sdigest'][oldS[sample]] == sdigest[i] for i,sample in enumerate(samples)],dtype=bool)
+        keptP = np.array([parent in oldP and old['pdigest'][oldP[parent]] == pdigest[i] for i,parent in enumerate(parents)],dtype=bool)
+        # Stored pairs between unchanged animals, as positions in samples and parents
+        si,pj = np.zeros(0,dtype=int),np.zeros(0,dtype=int)
+        disc,sites = np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+        if old is not None:
+            spos = np.zeros(len(old['samples']),dtype=int)-1
+            ppos = np.zeros(len(old['parents']),dtype=int)-1
+            for i,sample in enumerate(samples):
+                if keptS[i]: spos[oldS[sample]] = i
+            for j,parent in enumerate(parents):
+                if keptP[j]: ppos[oldP[parent]] = j
+            si,pj = spos[old['si']],ppos[old['pj']]
+            ok = (si >= 0) & (pj >= 0)
+            si,pj,disc,sites = si[ok],pj[ok],old['disc'][ok],old['sites'][ok]
+        # New samples against all parents, old samples against new parents
+        pairs = [(si,pj,disc,sites)]
+        scored = 0
+        for rows,cols in [(np.nonzero(~keptS)[0],np.arange(len(parents))),(np.nonzero(keptS)[0],np.nonzero(~keptP)[0])]:
+            if len(rows) == 0 or len(cols) == 0: continue
+            scored += len(rows)*len(cols)
+            step = self.rowBlock(len(cols))
+            for start in range(0,len(rows),step):
+                block = rows[start:start+step]
+                if self.verbose: sys.stdout.write('Checking: %s to %s vs. %d animals\n' % (samples[block[0]],samples[block[-1]],len(cols)))
+                d,n = self.blockCounts(srows[block],prows[cols])
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    i,j = np.nonzero((n > 0) & (100*d / n <= limit))
+                pairs.append((block[i],cols[j],d[i,j],n[i,j]))
+        si,pj,disc,sites = [np.concatenate(x) for x in zip(*pairs)]
+        order = np.lexsort((pj,si))
+        si,pj,disc,sites = si[order],pj[order],disc[order],sites[order]
+        heaps = {}
+        current,allowed = -1,None
+        for k in range(len(si)):
+            sample,parent = samples[si[k]],parents[pj[k]]
+            if parent == sample or 100*disc[k] / sites[k] > limit: continue
+            if self.pruneindex is not None:
+                if si[k] != current: current,allowed = si[k],self.pruneMask(sample)
+                if not allowed[pj[k]]: continue
+            if self.topk:
+                pushTop(heaps.setdefault(si[k],[]),self.topk,100*disc[k] / sites[k],sites[k],pj[k],disc[k])
+                continue
+            fout.write('%s\t%s\t%d\t%d\t%.2f\n' % (sample,parent,disc[k],sites[k],100*disc[k] / sites[k]))
+        for i in sorted(heaps): self.writeTop(fout,samples[i],parents,heaps[i])
+        stored = limit
+        if old is not None: stored = min(limit,old['limit'])
+        self.results.save({'samples':np.array(samples),'parents':np.array(parents),
+                           'sdigest':sdigest,'pdigest':pdigest,'markers':markers,'limit':stored,
+                           'si':si,'pj':pj,'disc':disc,'sites':sites})
+        sys.stderr.write('Incremental: %d new or changed samples, %d new or changed parents, %d of %d pairs scored\n' % ((~keptS).sum(),(~keptP).sum(),scored,len(samples)*len(parents)))
+
+    def rowDigests(self,irows):
+        """
+            Returns a digest of the genotypes of every row, the same whatever allele of a
+            marker was coded as hom-ref (markers are oriented on their sorted alleles)
+        """
+        flip = np.array([len(self.mark[mark]['alleles']) > 1 and self.mark[mark]['alleles'][0] > self.mark[mark]['alleles'][1] for mark in self.marklist],dtype=bool)
+        res = []
+        for start in range(0,len(irows),self.blocksize):
+            r,a,n = self.indicators(irows[start:start+self.blocksize],bool)
+            r,a = np.where(flip,a,r),np.where(flip,r,a)
+            for row in np.packbits(np.concatenate([r,a,n],axis=1),axis=1):
+                res.append(hashlib.sha1(row.tobytes()).hexdigest()[:16])
+        return np.array(res)
+
+    def shards(self,items):
+        # Splits a list into blocks that are handled by one worker each
+        if self.workers <= 1: return [items]
+        return [items[i:i+self.blocksize] for i in range(0,len(items),self.blocksize)]
+
+    def runShards(self,fout,method,shards,*args):
+        """
+            Calls method(fout,shard,*args) for every shard, in worker processes when
+            more than one worker is requested. Output is written in shard order, the
+            same as a serial run. Returns the sum of what the calls return
+        """
+        global _shared
+        found = 0
+        if self.workers <= 1:
+            for shard in shards: found += getattr(self,method)(fout,shard,*args) or 0
+            return found
+        self.shareGenos()
+        _shared = self
+        if hasattr(multiprocessing,'get_context'): pool = multiprocessing.get_context('fork').Pool(self.workers)
+        else: pool = multiprocessing.Pool(self.workers)
+        try:
+            for out,n,stats in pool.imap(_runShard,[(method,shard,args) for shard in shards]):
+                fout.write(out)
+                found += n
+                for k in stats: self.exitstats[k] += stats[k]
+        finally:
+            pool.close()
+            pool.join()
+            _shared = None
+        return found
+
+    def shareGenos(self):
+        """
+            Moves the genotype store into a memory-mapped file, so that forked workers
+            read the same pages instead of copying the matrix
+        """
+        if isinstance(self.gen,np.memmap): return
+        fd,path = tempfile.mkstemp(prefix='pedcheck',suffix='.gen')
+        os.close(fd)
+        shared = np.memmap(path,dtype=self.gen.dtype,mode='w+',shape=self.gen.shape)
+        shared[:] = self.gen
+        shared.flush()
+        os.remove(path) # The mapping stays valid until the process exits
+        self.gen = shared
+
+    def blockCounts(self,rows1,rows2,cols=None,ind1=None):
+        """
+            Returns discords and informative sites for all pairs between two lists of rows, on the given columns
+            ind1 can hold the indicators of rows1 on all markers, built once by a caller scoring them against
+            several lists of rows
+        """
+        disc = np.zeros((len(rows1),len(rows2)),dtype=np.int64)
+        sites = np.zeros((len(rows1),len(rows2)),dtype=np.int64)
+        for chunk in ([cols] if cols is not None else self.markerChunks(disc.nbytes+sites.nbytes)):
+            if ind1 is None: ind = self.indicators(rows1,cols=chunk)
+            else: ind = tuple(m[:,chunk] for m in ind1)
+            for start in range(0,len(rows2),self.blocksize):
+                end = start+self.blocksize
+                d,n = pairCounts(ind,self.indicators(rows2[start:end],cols=chunk))
+                disc[:,start:end] += d
+                sites[:,start:end] += n
+        return disc,sites
+
+    def blockCountsEarly(self,rows1,rows2,limit,ind1=None):
+        """
+            Same as blockCounts for the pairs that can get under the limit, the early exit of
+            findSingleDiscordsEarly for blocks. The markers are counted in steps (exitstep markers,
+            doubling), a pair is stopped once it stays over the limit even if every remaining marker
+            was informative and without discords. Only the parents not stopped for every sample of
+            the block are counted on. Stopped pairs get no sites.
+        """
+        nmark = len(self.mark)
+        disc = np.zeros((len(rows1),len(rows2)),dtype=np.int64)
+        sites = np.zeros((len(rows1),len(rows2)),dtype=np.int64)
+        stopped = np.zeros(disc.shape,dtype=bool)
+        alive = np.arange(len(rows2))
+        chunk = self.markerChunks(disc.nbytes+sites.nbytes)[0]
+        start,step = 0,self.exitstep
+        while start < nmark and len(alive) > 0:
+            end = min(start+min(step,chunk.stop-chunk.start),nmark)
+            d,n = self.blockCounts(rows1,rows2[alive],slice(start,end),ind1)
+            disc[:,alive] += d
+            sites[:,alive] += n
+            self.exitstats['scanned'] += len(rows1)*len(alive)*(end-start)
+            start,step = end,2*step
+            if end == nmark: break
+            with np.errstate(divide='ignore',invalid='ignore'):
+                stopped[:,alive] = (disc[:,alive] > 0) & (100*disc[:,alive] / (sites[:,alive]+nmark-end) > limit)
+            alive = alive[~stopped[:,alive].all(axis=0)]
+        self.exitstats['pairs'] += disc.size
+        self.exitstats['markers'] += disc.size*nmark
+        self.exitstats['stopped'] += int(stopped.sum())
+        sites[stopped] = 0
+        return disc,sites
+
+    def parentCounts(self,rows1,rows2,limit,ind1=None):
+        # Discords and informative sites between samples and potential parents, with the early exit if set
+        if self.earlyexit: return self.blockCountsEarly(rows1,rows2,limit,ind1)
+        return self.blockCounts(rows1,rows2,ind1=ind1)
+
+    def writeParents(self,fout,sample,parents,disc,sites,limit):
+        # Writes the candidate parents of one sample that are within the limit, returns the number written
+        with np.errstate(divide='ignore',invalid='ignore'):
+            pct = 100*disc / sites
+        found = 0
+        for i in np.nonzero((sites > 0) & (pct <= limit))[0]:
+            if parents[i] == sample: continue
+            fout.write('%s\t%s\t%d\t%d\t%.2f\n' % (sample,parents[i],disc[i],sites[i],pct[i]))
+            found += 1
+        return found
+
+    def selectPanel(self,nmark):
+        """ Returns the columns of the nmark markers with the highest minor allele frequency """
+        counts = np.zeros((3,len(self.mark)))
+        for start in range(0,len(self.gen),self.blocksize):
+            r,a,n = self.indicators(np.arange(start,min(start+self.blocksize,len(self.gen))),np.float64)
+            counts += [r.sum(0),a.sum(0),n.sum(0)]
+        r,a,n = counts
+        with np.errstate(divide='ignore',invalid='ignore'):
+            p = np.where(n > 0,(n+a-r) / (2*n),0) # Frequency of the second allele
+        maf = np.minimum(p,1-p)
+        return np.sort(np.argsort(-maf,kind='stable')[:nmark])
+
+    def screenPairs(self,samples,limit):
+        """
+            First stage of the screened parent search
+            All pairs of samples and potential parents are scored on a panel of high-MAF markers,
+            the pairs within the relaxed screening limit (or with no informative panel sites) are
+            kept in self.candidates for the full check. A random sample of the rejected pairs is
+            checked on all markers to estimate how many true hits the screen loses.
+        """
+        screenlimit = self.screenlimit
+        if screenlimit is None: screenlimit = min(2*limit,100)
+        panel = self.selectPanel(self.screen)
+        parents = list(self.ped2)
+        prows = np.array([self.ped2[parent]['rank'] for parent in parents],dtype=int)
+        pindex = dict((parent,i) for i,parent in enumerate(parents))
+        genotyped = [sample for sample in samples if sample in self.ped1]
+        self.candidates = dict((sample,np.zeros(0,dtype=int)) for sample in samples)
+        rng = np.random.RandomState(1)
+        keys,rejected = np.zeros(0),np.zeros(0,dtype=np.int64) # Random keys and codes (sample*parents+parent) of the sampled rejected pairs
+        self.screenstats = {'pairs':0,'rejected':0,'markers':len(panel),'limit':screenlimit}
+        step = self.rowBlock(len(parents),4)
+        for start in range(0,len(genotyped),step):
+            block = genotyped[start:start+step]
+            if self.verbose: sys.stdout.write('Screening: %s to %s vs. %d animals\n' % (block[0],block[-1],len(parents)))
+            disc,sites = self.blockCounts([self.ped1[sample]['rank'] for sample in block],prows,panel)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                keep = (sites == 0) | (100*disc / sites <= screenlimit)
+            valid = np.ones(keep.shape,dtype=bool)
+            for i,sample in enumerate(block):
+                if sample in pindex: valid[i,pindex[sample]] = False
+                if self.pruneindex is not None: valid[i] &= self.pruneMask(sample)
+                self.candidates[sample] = np.nonzero(keep[i] & valid[i])[0]
+            self.screenstats['pairs'] += int(valid.sum())
+            irej,jrej = np.nonzero(~keep & valid)
+            self.screenstats['rejected'] += len(irej)
+            # Keeps the rejected pairs with the smallest random keys, a uniform sample
+            keys = np.concatenate([keys,rng.random_sample(len(irej))])
+            rejected = np.concatenate([rejected,(start+irej)*len(parents)+jrej])
+            if len(keys) > self.screensample:
+                order = np.argpartition(keys,self.screensample)[:self.screensample]
+                keys,rejected = keys[order],rejected[order]
+        misses = 0
+        for code in np.sort(rejected):
+            if self.findSingleDiscords(genotyped[code//len(parents)],parents[code%len(parents)],limit): misses += 1
+        self.screenstats['sampled'] = len(rejected)
+        self.screenstats['misses'] = misses
+
+    def reportScreen(self,found):
+        # Writes the number of pairs rejected by the screen and the estimated false-negative rate
+        stats = self.screenstats
+        missed = 0.0
+        if stats['sampled'] > 0: missed = stats['rejected']*stats['misses'] / stats['sampled']
+        rate = 0.0
+        if found+missed > 0: rate = missed / (found+missed)
+        sys.stderr.write('Screen: %d of %d pairs rejected on %d markers (limit %.2f)\n' % (stats['rejected'],stats['pairs'],stats['markers'],stats['limit']))
+        sys.stderr.write('Screen: %d of %d sampled rejected pairs pass on all markers, estimated %.1f missed of %.1f hits, false-negative rate %.4f\n' % (stats['misses'],stats['sampled'],missed,found+missed,rate))
+        self.candidates = None
 
     def findPed(self,outfile,limit):
+        fout = self.openReport(outfile)
+        if self.prune: self.buildPruneIndex([sample for sample in self.pedlist if sample in self.ped1])
+        if self.screen: self.screenPairs(self.pedlist,limit)
+        found = self.runShards(fout,'findPedShard',self.shards(self.pedlist),limit)
+        if self.screen: self.reportScreen(found)
+        if self.earlyexit: self.reportEarlyExit()
+        self.closeReport(fout,outfile)
+
+    def findPedShard(self,fout,samples,limit):
+        # Writes the potential parents and couples for a list of samples, returns the number of single parents found
         res = {} # All 1-to-1 pairings under the given limit
         parents = {} # List of potential parents for each sample
-        if not outfile: fout = sys.stdout
-        else: fout = open(outfile,'w')
+        if self.candidates is not None: allParents = list(self.ped2)
         # Locate all single parents
-        for sample in self.pedlist:
+        for sample in samples:
             parents[sample] = []
-            for parent in self.ped2:
+            if self.candidates is not None: passed = set(allParents[i] for i in self.candidates[sample])
+            if self.pruneindex is not None and sample in self.ped1: allowed = self.pruneMask(sample)
+            for j,parent in enumerate(self.ped2):
                 if sample == parent: continue
+                if self.pruneindex is not None and sample in self.ped1 and not allowed[j]: continue
                 if (parent,sample) in res or (sample,parent) in res:
                     parents[sample].append(parent)
                     continue
+                if self.candidates is not None and parent not in passed: continue
                 temp  = self.findSingleDiscords(sample,parent,limit)
                 if not temp: continue
                 res[sample,parent] = temp
                 parents[sample].append(parent)
         # Search single parents to find couples
-        for sample in self.pedlist:
+        for sample in samples:
             foundCouple = False
             if len(parents[sample]) == 0: continue
-            for i,parent1 in enumerate(parents[sample]):
-                if len(parents[sample]) == 1:
-                    continue
-                for parent2 in parents[sample][i+1:]:
-                    sex1,sex2 = self.ped2[parent1]['sex'],self.ped2[parent2]['sex']
-                    if sex1 == '1' and sex2 == '0' or sex1 == '1' and sex2 == '3' or sex1 == '3' and sex2 == '0': father,mother = parent1,parent2
-                    elif sex1 == '0' and sex2 == '1' or sex1 == '0' and sex2 == '3' or sex1 == '3' and sex2 == '1': father,mother = parent2,parent1
-                    elif sex1 == sex2 and sex1 != '3': continue
-                    else:
-                        father,mother = parent1,parent2
-                    temp = self.findDiscords(sample,father,mother,limit*2)
-                    if not temp: continue
-                    f1,f2,f3 = temp[father]['disc'],temp[father]['sites'],temp[father]['pct']
-                    m1,m2,m3 = temp[mother]['disc'],temp[mother]['sites'],temp[mother]['pct']
-                    t1,t2,t3 = temp[father,mother]['disc'],temp[father,mother]['sites'],temp[father,mother]['pct']
-                    fout.write('%s\t%s\t%d\t%d\t%.2f\t%s\t%d\t%d\t%.2f\t%d\t%d\t%.2f\n' % (sample,father,f1,f2,f3,mother,m1,m2,m3,t1,t2,t3))
-                    foundCouple = True
+            if len(parents[sample]) > 1: foundCouple = self.writeCouples(fout,sample,parents[sample],res,limit*2)
             if not foundCouple:
                 for parent in parents[sample]:
                     try: temp = res[sample,parent]
@@ -431,23 +1606,57 @@ class SNP(object):
                         m3 = t3 = -1
                         father,mother = parent,'0'
                     fout.write('%s\t%s\t%d\t%d\t%.2f\t%s\t%d\t%d\t%.2f\t%d\t%d\t%.2f\n' % (sample,father,f1,f2,f3,mother,m1,m2,m3,t1,t2,t3))
+        return sum(len(parents[sample]) for sample in samples)
         
+    def writeCouples(self,fout,sample,candidates,res,limit):
+        """
+            Scores a sample against every couple of its potential parents in one go, and writes
+            the couples within the limit in the same order and format as calling findDiscords for
+            each couple. Couples of the same known sex are skipped. Returns True if any was written
+        """
+        rows = [self.ped2[parent]['rank'] for parent in candidates]
+        disc = sites = 0
+        for cols in self.markerChunks():
+            ind = self.indicators(rows,bool,cols)
+            d,n = coupleCounts(self.indicators([self.ped1[sample]['rank']],bool,cols),ind,ind)
+            disc,sites = disc+d,sites+n
+        sex = np.array([self.ped2[parent]['sex'] for parent in candidates])
+        sex1,sex2 = sex[:,None],sex[None,:]
+        valid = ~((sex1 == sex2) & (sex1 != '3'))
+        # The second parent is the father when the first is a known mother or the second a known father
+        swap = ((sex1 == '0') & ((sex2 == '1') | (sex2 == '3'))) | ((sex1 == '3') & (sex2 == '1'))
+        with np.errstate(divide='ignore',invalid='ignore'):
+            pct = 100*disc / sites
+        single = {}
+        for parent in candidates:
+            try: single[parent] = res[sample,parent]
+            except KeyError: single[parent] = res[parent,sample]
+        found = False
+        for i,j in zip(*np.nonzero(np.triu((sites > 0) & (pct <= limit) & valid,1))):
+            father,mother = candidates[i],candidates[j]
+            if swap[i,j]: father,mother = mother,father
+            f,m = single[father],single[mother]
+            fout.write('%s\t%s\t%d\t%d\t%.2f\t%s\t%d\t%d\t%.2f\t%d\t%d\t%.2f\n' % (sample,father,f['disc'],f['sites'],f['pct'],mother,m['disc'],m['sites'],m['pct'],disc[i,j],sites[i,j],100*int(disc[i,j]) / int(sites[i,j])))
+            found = True
+        return found
+
     def findDif(self,anim,father,limit):
         """
             Detects all difference within the given trio
             Will work even if one of the parents is missing
         """
+        if self.store == 'packed': return self.findDifPacked(anim,father,limit)
         if self.verbose: sys.stdout.write('Checking: %s vs. %s ' % (anim,father))
         results = {}
         # Father
         try:
-            resF = self.gen[self.ped2[father]['rank'],:]-self.gen[self.ped[anim]['rank'],:]
-            wrongF = resF!=0
-            sitesF = len(resF) - np.count_nonzero(np.isnan(resF))
+            gF,gA = self.gen[self.ped2[father]['rank'],:],self.gen[self.ped[anim]['rank'],:]
+            okF = libSNP.called(gF) & libSNP.called(gA)
+            wrongF = (gF != gA) | ~okF # Missing calls count as differences
+            sitesF = np.count_nonzero(okF)
         except KeyError:
-            wrongF = [False]*len(self.mark)
+            wrongF = []
             sitesF = 0
-            resF = wrongF
         if sitesF == 0:
             pct = -1
         else:
@@ -458,11 +1667,73 @@ class SNP(object):
         return results
         
     def findDup(self,outfile,limit):
-        if outfile: fout = open(outfile,'w')
-        else: fout = sys.stdout
+        fout = self.openReport(outfile)
+        if self.lsh: self.findDupLSH(fout)
+        elif self.memlimit: self.runShards(fout,'findDupBlockShard',self.shards(list(range(len(self.pedlist)))),limit)
+        else: self.runShards(fout,'findDupShard',self.shards(list(range(len(self.pedlist)))),limit)
+        self.closeReport(fout,outfile)
+
+    def findDupLSH(self,fout):
+        """
+            Writes the pairs that differ on at most lshlimit percent of the markers, as counted by findDif
+            (the near-identical pairs, not the pairs above the level written by the exhaustive search)
+            Candidate pairs are samples with identical genotypes on all markers of at least one band,
+            every band being lshrows markers drawn at random. A pair that differs on a fraction d of
+            the markers collides in a band with probability of at least (1-d)^rows, the number of
+            bands is chosen so that pairs at the limit are proposed with probability lshrecall.
+            The candidates are checked with findDif.
+        """
+        lim = self.lshlimit
+        rows = self.lshrows
+        hit = (1-lim/100.0)**rows # Collision probability in one band at the limit
+        if hit >= 1: bands = 1
+        elif hit <= 0 or np.log1p(-hit) == 0: bands = None
+        else: bands = int(np.ceil(np.log1p(-self.lshrecall) / np.log1p(-hit)))
+        if bands is None or bands > self.lshmaxbands:
+            sys.stderr.write('ERROR: --lsh-limit %.2f needs more than %d bands of %d markers for recall %.4f, use fewer --lsh-rows or leave out --lsh\n' % (lim,self.lshmaxbands,rows,self.lshrecall))
+            sys.exit(1)
+        recall = -np.expm1(bands*np.log1p(-hit))
+        samples = [i for i,sample in enumerate(self.pedlist) if sample in self.ped2]
+        irows = np.array([self.ped2[self.pedlist[i]]['rank'] for i in samples],dtype=int)
+        rng = np.random.RandomState(1)
+        cols = rng.randint(0,len(self.mark),size=(bands,rows))
+        # Genotypes on the band markers as base 3 numbers, -1 when a call is missing
+        keys = np.zeros((len(samples),bands),dtype=np.int64)
+        weights = 3**np.arange(rows,dtype=np.int64)
+        for start in range(0,len(samples),self.blocksize):
+            r,a,n = self.indicators(irows[start:start+self.blocksize],np.int8,cols.ravel())
+            codes = (a*2 + (n-r-a)).astype(np.int64).reshape(len(r),bands,rows)
+            keys[start:start+self.blocksize] = np.where(n.reshape(len(r),bands,rows).all(axis=2),np.dot(codes,weights),-1)
+        pairs = []
+        for b in range(bands):
+            valid = np.nonzero(keys[:,b] >= 0)[0]
+            order = valid[np.argsort(keys[valid,b],kind='stable')]
+            bounds = np.nonzero(np.diff(keys[order,b]))[0]+1
+            for group in np.split(order,bounds):
+                if len(group) < 2: continue
+                group = np.sort(group)
+                i,j = np.triu_indices(len(group),1)
+                pairs.append(group[i]*len(samples)+group[j])
+        pairs = np.unique(np.concatenate(pairs)) if pairs else np.zeros(0,dtype=np.int64)
+        pairs = [(samples[p//len(samples)],samples[p % len(samples)]) for p in pairs]
+        found = self.runShards(fout,'findDupPairs',self.shards(pairs),lim)
+        sys.stderr.write('LSH: %d bands of %d markers, recall %.4f at %.2f%% difference, %d candidate pairs, %d duplicates\n' % (bands,rows,recall,lim,len(pairs),found))
+
+    def findDupPairs(self,fout,pairs,lim):
+        # Writes the pairs (positions in pedlist) with at most lim percent differences, returns the number written
+        found = 0
+        for i,j in pairs:
+            temp = self.findDif(self.pedlist[i],self.pedlist[j],-1)
+            if temp['pct'] < 0 or temp['pct'] > lim: continue
+            fout.write('%s\t%s\t%d\t%d\t%.2f\n' % (self.pedlist[i],self.pedlist[j],temp['disc'],temp['sites'],temp['pct']))
+            found += 1
+        return found
+
+    def findDupShard(self,fout,indices,limit):
+        # Writes the pairs for the samples at the given positions in pedlist and all later samples
         lim = 100-limit
-        # Checks the provided pedigree for potential parents
-        for i,sample1 in enumerate(self.pedlist):
+        for i in indices:
+            sample1 = self.pedlist[i]
             for sample2 in self.pedlist[i+1:]:
                 temp  = self.findDif(sample1,sample2,lim)
                 if not temp:
@@ -470,11 +1741,141 @@ class SNP(object):
                     continue
                 f1,f2,f3 = temp['disc'],temp['sites'],temp['pct']
                 if f3 > lim: fout.write('%s\t%s\t%d\t%d\t%.2f\n' % (sample1,sample2,f1,f2,f3))
-        if outfile: fout.close()
+
+    def findDupBlockShard(self,fout,indices,limit):
+        """
+            Same as findDupShard, counting identical calls for blocks of samples against all later
+            samples with matrix products, summed over the marker chunks
+            As in findDif, every marker that is not an identical call counts as a difference
+        """
+        lim = 100-limit
+        nmark = len(self.mark)
+        step = self.rowBlock(len(self.pedlist),5)
+        for start in range(0,len(indices),step):
+            block = indices[start:start+step]
+            later = [j for j in range(block[0]+1,len(self.pedlist)) if self.pedlist[j] in self.ped2]
+            rows1 = np.array([self.ped[self.pedlist[i]]['rank'] for i in block],dtype=int)
+            rows2 = np.array([self.ped2[self.pedlist[j]]['rank'] for j in later],dtype=int)
+            equal = np.zeros((len(block),len(later)),dtype=np.int64)
+            sites = np.zeros((len(block),len(later)),dtype=np.int64)
+            for cols in self.markerChunks(equal.nbytes+sites.nbytes):
+                ind1 = self.indicators(rows1,cols=cols)
+                for k in range(0,len(later),self.blocksize):
+                    e,n = equalCounts(ind1,self.indicators(rows2[k:k+self.blocksize],cols=cols))
+                    equal[:,k:k+self.blocksize] += e
+                    sites[:,k:k+self.blocksize] += n
+            disc = nmark-equal
+            with np.errstate(divide='ignore',invalid='ignore'):
+                pct = 100*disc / sites
+            after = np.array(later)[None,:] > np.array(block)[:,None]
+            for a,b in zip(*np.nonzero(after & (sites > 0) & (pct > lim))):
+                fout.write('%s\t%s\t%d\t%d\t%.2f\n' % (self.pedlist[block[a]],self.pedlist[later[b]],disc[a,b],sites[a,b],pct[a,b]))
+
+#*****************************************************************************************************
+# Versions of the pair tests working directly on the packed genotype store.
+# Opposite homozygotes and informative sites are counted with bitwise AND and popcount
+# over 64-bit words, and give the same numbers as the float versions above.
+
+    def findDiscordsPacked(self,anim,father,mother,limit=100):
+        """ Same as findDiscords, for the packed genotype store """
+        results = {}
+        if self.verbose: sys.stdout.write('Checking: %s vs. %s and %s' % (anim,father,mother))
+        zero = np.zeros_like(self.allsites)
+        wrongF = wrongM = wrongT = zero
+        okF = okM = okT = self.allsites # Sites where each comparison is informative
+        try:
+            rA,aA,hA,nA = self.splitPacked(self.ped1[anim]['rank'])
+        except KeyError:
+            rA = None
+        # Father
+        try:
+            if rA is None: raise KeyError(anim)
+            rF,aF,hF,nF = self.splitPacked(self.ped2[father]['rank'])
+            wrongF = (rF & aA) | (aF & rA)
+            okF = nF & nA
+            sitesF = popcount(okF)
+        except KeyError:
+            sitesF = 0
+        if sitesF == 0:
+            pct = -1
+        else:
+            pct = 100*popcount(wrongF) / sitesF
+        if self.verbose: sys.stdout.write(' %.3f' % pct)
+        results[father] = {'disc':popcount(wrongF),'sites':sitesF,'pct':pct}
+        # Mother
+        try:
+            if rA is None: raise KeyError(anim)
+            rM,aM,hM,nM = self.splitPacked(self.ped2[mother]['rank'])
+            wrongM = (rM & aA) | (aM & rA)
+            okM = nM & nA
+            sitesM = popcount(okM)
+        except KeyError:
+            sitesM = 0
+        if sitesM == 0:
+            pct = -1
+        else:
+            pct = 100*popcount(wrongM) / sitesM
+        if self.verbose: sys.stdout.write(' %.3f' % pct)
+        results[mother] = {'disc':popcount(wrongM),'sites':sitesM,'pct':pct}
+        # Trios, parents homozygous for the same allele and a heterozygous offspring
+        if wrongF is not zero and wrongM is not zero:
+            wrongT = ((rF & rM) | (aF & aM)) & hA
+            okT = nF & nM & nA
+        wrongTrio = wrongF | wrongM | wrongT
+        sitesT = popcount(okF & okM & okT)
+        if sitesT == 0:
+            pct = -1
+        else:
+            pct = 100*popcount(wrongTrio) / sitesT
+        if self.verbose: sys.stdout.write(' %.3f\n' % pct)
+        if pct > limit or pct < 0: return None
+        results[father,mother] = {'disc':popcount(wrongTrio),'sites':sitesT,'pct':pct}
+        return results
+
+    def findSingleDiscordsPacked(self,anim,father,limit):
+        """ Same as findSingleDiscords, for the packed genotype store """
+        if self.verbose: sys.stdout.write('Checking: %s vs. %s ' % (anim,father))
+        try:
+            rF,aF,hF,nF = self.splitPacked(self.ped2[father]['rank'])
+            rA,aA,hA,nA = self.splitPacked(self.ped1[anim]['rank'])
+            discF = popcount((rF & aA) | (aF & rA))
+            sitesF = popcount(nF & nA)
+        except KeyError:
+            discF = sitesF = 0
+        if sitesF == 0:
+            pct = -1
+        else:
+            pct = 100*discF / sitesF
+        if self.verbose: sys.stdout.write('%d\n' % pct)
+        if pct > limit or pct < 0: return None
+        return {'disc':discF,'sites':sitesF,'pct':pct}
+
+    def findDifPacked(self,anim,father,limit):
+        """
+            Same as findDif, for the packed genotype store
+            As in findDif, markers missing in either sample are counted as differences
+        """
+        if self.verbose: sys.stdout.write('Checking: %s vs. %s ' % (anim,father))
+        try:
+            i1,i2 = self.ped2[father]['rank'],self.ped[anim]['rank']
+            n1 = self.gen[i1,0] | self.gen[i1,1]
+            n2 = self.gen[i2,0] | self.gen[i2,1]
+            same = ~(self.gen[i1,0] ^ self.gen[i2,0]) & ~(self.gen[i1,1] ^ self.gen[i2,1]) & n1 & n2
+            sitesF = popcount(n1 & n2)
+            discF = len(self.mark) - popcount(same)
+        except KeyError:
+            discF = sitesF = 0
+        if sitesF == 0:
+            pct = -1
+        else:
+            pct = 100*discF / sitesF
+        if self.verbose: sys.stdout.write('%d/%d\n' % (pct,limit))
+        if pct < limit: return None
+        return {'disc':discF,'sites':sitesF,'pct':pct}
 
 def main():
     parser = argparse.ArgumentParser(description='Processes genotypes.')
-    parser.add_argument('ingeno',help='Input genotypes file')
+    parser.add_argument('ingeno',help='Input genotypes file, a .bed file is read as a binary Plink fileset with .bim and .fam')
     parser.add_argument('-r','--repfile',help='Output report file')
     parser.add_argument('-o','--mode',help='Type of operation (check/findparent/findped/dup)',default='check')
     parser.add_argument('-j','--reference',help='File with potential parents')
@@ -484,22 +1885,107 @@ def main():
     parser.add_argument('-c',dest='infocol',type=int,help='Non-genotype columns', default=3)
     parser.add_argument('-a',dest='allele',type=int,help='Alleleformat, 1=0/1/2, 2=11/13/33, 3=1 1/1 3/3 3', default=3)
     parser.add_argument('-l',dest='limit',type=float,help='Noise level in percent', default = 100.0)
+    parser.add_argument('-b','--blocksize',type=int,help='Samples per block in batched searches',default=256)
+    parser.add_argument('-w','--workers',type=int,help='Worker processes for findparent/findped/dup',default=1)
+    parser.add_argument('-s','--store',help='Genotype storage (float/int8/packed), int8 uses 1 byte and packed 2 bits per genotype',default='float')
+    parser.add_argument('--screen',type=int,help='Markers with the highest MAF used to screen pairs in findparent/findped before the full check',default=0)
+    parser.add_argument('--screen-limit',type=float,help='Noise level in percent for passing the screen, default twice -l')
+    parser.add_argument('--screen-sample',type=int,help='Rejected pairs checked on all markers to estimate the false-negative rate',default=1000)
+    parser.add_argument('--lsh',action="store_true",help='Dup mode: find the near-identical pairs (at most --lsh-limit percent differences) by locality-sensitive hashing instead of comparing all pairs, -l is not used')
+    parser.add_argument('--lsh-limit',type=float,help='Percent differences of the pairs found with --lsh',default=1.0)
+    parser.add_argument('--lsh-recall',type=float,help='Probability of finding a pair at --lsh-limit, sets the number of hash bands',default=0.99)
+    parser.add_argument('--lsh-rows',type=int,help='Markers per hash band, at most 39',default=20)
+    parser.add_argument('--results',help='Findparent: file with stored pair counts, only new or changed animals are scored and the file is updated')
+    parser.add_argument('--mem-limit',type=int,help='Memory budget in MB, genotypes are kept on disk (in TMPDIR) and processed in marker chunks, with smaller sample blocks when there are many parents')
+    parser.add_argument('--early-exit',action="store_true",help='Findparent/findped: stop counting a pair once it can not get under the limit')
+    parser.add_argument('--top-k',type=int,help='Findparent: only the K best parents of every sample, best first',default=0)
+    parser.add_argument('--prune',action="store_true",help='Findparent/findped: skip parents ruled out by the pedigree (descendants of the sample, birth years with --birth-col)')
+    parser.add_argument('--birth-col',type=int,help='Column (from 1) with birth years in the pedigree file, used by --prune')
+    parser.add_argument('--min-parent-age',type=float,help='Years between the births of a parent and its offspring, used with --birth-col',default=1)
+    parser.add_argument('--stream',type=int,help='Findparent: read the text reference file (-j) N samples at a time, only the query samples are kept in memory',default=0)
+    parser.add_argument('--index',action="store_true",help='Check: read only the lines of the animals checked and their parents, found through a sidecar index of each genotype file (FILE.idx, built on first use)')
+    parser.add_argument('--cache',help='Directory for cached binary copies of the genotype files')
+    parser.add_argument('--rebuild-cache',action="store_true",help='Parse the genotype files again and replace their cache entries')
+    parser.add_argument('--clear-cache',action="store_true",help='Remove the cache entries of the genotype files and run without the cache')
+    parser.add_argument('--profile',help='JSON file with the time and memory used by each stage of the run')
     parser.add_argument('-v','--verbose',action="store_true",help='Prints runtime info')
     args = parser.parse_args()
-    gen = SNP(args.infocol,args.allele,args.informat,args.verbose)
-    # Read pedigree information, collect from genotype file if needed
-    gen.collectPedigree(args.pedigree,args.ingeno,args.reference)
-    # Read marker information, collect from genotype file if needed
-    if args.markers:
-        gen.readMarkers(args.markers)
+    prof = libSNP.Profile(args.profile,'pedcheck')
+    gen = SNP(args.infocol,args.allele,args.informat,args.verbose,args.store.lower())
+    gen.blocksize = args.blocksize
+    if args.mem_limit: gen.memlimit = args.mem_limit*1024*1024
+    gen.workers = args.workers
+    gen.screen = args.screen
+    gen.earlyexit = args.early_exit
+    gen.topk = args.top_k
+    gen.prune = args.prune
+    gen.birthcol = args.birth_col
+    gen.minage = args.min_parent_age
+    if args.stream:
+        if args.mode.lower() != 'findparent' or not args.reference or libSNP.isPlink(args.reference):
+            sys.stderr.write('ERROR: --stream needs findparent and a text reference file\n')
+            sys.exit(1)
+        if args.screen or args.results or args.prune:
+            sys.stderr.write('ERROR: --stream can not be combined with --screen, --results or --prune\n')
+            sys.exit(1)
+        gen.stream = args.stream
+    if args.early_exit:
+        if args.mode.lower() not in ['findparent','findped'] or args.results:
+            sys.stderr.write('ERROR: --early-exit needs findparent or findped, without --results\n')
+            sys.exit(1)
+    if args.index:
+        if args.mode.lower() != 'check' or args.cache or not gen.canIndex(args.ingeno,args.reference):
+            sys.stderr.write('ERROR: --index needs check mode and uncompressed text genotype files, without --cache\n')
+            sys.exit(1)
+        gen.index = True
+    gen.screenlimit = args.screen_limit
+    gen.screensample = args.screen_sample
+    gen.lsh = args.lsh
+    gen.lshlimit = args.lsh_limit
+    gen.lshrecall = args.lsh_recall
+    gen.lshrows = min(args.lsh_rows,39)
+    if args.results: gen.results = libSNP.ResultStore(args.results,args.verbose)
+    if args.cache:
+        cache = libSNP.GenoCache(args.cache,args.verbose)
+        if args.clear_cache:
+            for genofile in [args.ingeno,args.reference]:
+                if genofile: cache.clear(genofile)
+        else:
+            gen.cache = cache
+            gen.rebuild = args.rebuild_cache
+    if gen.index:
+        # Only the rows of the animals checked and their parents
+        prof.stage('read')
+        gen.readIndexed(args.pedigree,args.ingeno,args.reference,args.markers)
+        prof.count(animals=len(gen.ped),samples=len(gen.ped1),parents=len(gen.ped2),markers=len(gen.marklist))
+    elif gen.singlePass(args.ingeno,args.reference):
+        # Pedigree, markers and genotypes in one pass over each genotype file
+        prof.stage('read')
+        gen.ingest(args.pedigree,args.ingeno,args.reference,args.markers)
+        prof.count(animals=len(gen.ped),samples=len(gen.ped1),parents=len(gen.ped2),markers=len(gen.marklist))
     else:
-        gen.collectMarkers(args.ingeno)
-    gen.readGenos(args.ingeno,args.reference)
+        # Read pedigree information, collect from genotype file if needed
+        prof.stage('pedigree')
+        gen.collectPedigree(args.pedigree,args.ingeno,args.reference)
+        prof.count(animals=len(gen.ped),samples=len(gen.ped1),parents=len(gen.ped2))
+        # Read marker information, collect from genotype file if needed
+        prof.stage('markers')
+        if args.markers:
+            gen.readMarkers(args.markers)
+        else:
+            gen.collectMarkers(args.ingeno)
+        prof.count(markers=len(gen.marklist))
+        prof.stage('genotypes')
+        gen.readGenos(args.ingeno,args.reference)
+    prof.count(rows=len(gen.gen),genotypes=len(gen.gen)*len(gen.marklist),bytes_read=libSNP.bytesRead())
+    prof.stage(args.mode.lower(),workers=gen.workers,blocksize=gen.blocksize)
     if args.mode.lower() == 'check': gen.checkPed(args.repfile)
     elif args.mode.lower() == 'findparent': gen.findParent(args.repfile,args.limit)
     elif args.mode.lower() == 'findped': gen.findPed(args.repfile,args.limit)
     elif args.mode.lower() == 'dup': gen.findDup(args.repfile,args.limit)
     else: sys.stderr.write('ERROR: Unknown mode [%s]\n' % args.mode)
+    if args.verbose: libSNP.reportReads()
+    prof.write()
 
 if __name__ == '__main__':
     main()
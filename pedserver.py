@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+# Parentage server, keeps a reference panel in memory and answers pedcheck queries over HTTP
+
+"""
+    Reads the reference genotypes once and answers queries with the check, findparent,
+    findped and dup modes of pedcheck.py. A query is a genotype file in the same format
+    as the reference (header line with the markers included), sent as the body of a POST:
+
+      curl --data-binary @query.txt 'http://127.0.0.1:8765/findparent?limit=2&top=5'
+      curl --unix-socket /tmp/pedserver.sock --data-binary @query.txt 'http://x/check'
+
+    The reply is the report pedcheck.py would write for the query file with -j reference:
+      check:      the parents in the information columns of the query, looked up in the reference
+      findparent: potential parents of every query sample among the reference samples
+      findped:    potential parents and couples of every query sample among the reference samples
+      dup:        pairs of a query sample and a later query sample or any reference sample,
+                  as dup on the query samples followed by the reference samples
+
+    GET /status gives the panel as JSON. POST /reload (or SIGHUP) reads the reference file
+    given at startup again, to switch to another file replace it and reload. Queries running
+    during a reload finish on the old panel.
+"""
+
+from __future__ import division, print_function
+import os
+import sys
+import copy
+import json
+import time
+import signal
+import argparse
+import tempfile
+import threading
+import libSNP
+import pedcheck
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+    from StringIO import StringIO
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+    from io import StringIO
+
+MODES = ['check','findparent','findped','dup']
+
+class QueryError(Exception):
+    """ A query that can not be answered, status is the HTTP status of the reply """
+    def __init__(self,status,message):
+        Exception.__init__(self,message)
+        self.status = status
+
+class Panel(object):
+    """
+        The reference samples read into a pedcheck.SNP, with spare rows after them in the
+        genotype store. Every query takes spare rows for its samples while it runs, the
+        reference rows are only read.
+    """
+    def __init__(self,args,reference):
+        t = time.time()
+        gen = pedcheck.SNP(args.infocol,args.allele,args.informat,args.verbose,args.store.lower())
+        gen.blocksize = args.blocksize
+        if args.mem_limit: gen.memlimit = args.mem_limit*1024*1024
+        gen.topk = args.top_k
+        gen.spare = args.slots
+        if gen.singlePass(reference,None):
+            gen.ingest(None,reference,None,args.markers)
+        else:
+            gen.collectPedigree(None,reference,None)
+            if args.markers: gen.readMarkers(args.markers)
+            else: gen.collectMarkers(reference)
+            gen.readGenos(reference)
+        self.gen = gen
+        self.reference = reference
+        self.slots = args.slots
+        self.free = list(range(len(gen.ped1),len(gen.ped1)+args.slots))
+        self.rows = threading.Condition()
+        self.loaded = time.time()
+        self.seconds = self.loaded-t
+        self.queries = 0
+
+    def status(self):
+        with self.rows: free = len(self.free)
+        return {'reference':self.reference,'samples':len(self.gen.ped1),'markers':len(self.gen.marklist),
+                'store':self.gen.store,'slots':self.slots,'free':free,'queries':self.queries,
+                'loaded':time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(self.loaded)),
+                'load_seconds':round(self.seconds,3)}
+
+    def reserve(self,n):
+        # Takes n spare rows, waits for running queries to give theirs back when too few are free
+        if n > self.slots: raise QueryError(413,'%d samples in the query, the server takes at most %d\n' % (n,self.slots))
+        with self.rows:
+            while len(self.free) < n: self.rows.wait()
+            rows,self.free = self.free[:n],self.free[n:]
+        return rows
+
+    def release(self,rows):
+        with self.rows:
+            self.free += rows
+            self.rows.notify_all()
+
+    def query(self,mode,text,limit,topk):
+        """
+            Answers one query, text is the query genotype file. Returns the report.
+            The query runs on a shallow copy of the panel's SNP, sharing the genotype store,
+            with the query samples as ped1 and the reference as ped2. The alleles of the markers
+            are copied, alleles first seen in a query are only used for that query.
+        """
+        fd,path = tempfile.mkstemp(prefix='pedserver',suffix='.txt')
+        with os.fdopen(fd,'w') as fout: fout.write(text)
+        rows = []
+        try:
+            q = copy.copy(self.gen)
+            q.workers = 1 # No forking from the threads of the server
+            q.cache,q.cached,q.results = None,{},None
+            q.alleles = [a.copy() for a in self.gen.alleles]
+            q.mark = dict((mark,dict(info,alleles=list(info['alleles']))) for mark,info in self.gen.mark.items())
+            q.exitstats = {'pairs':0,'stopped':0,'scanned':0,'markers':0}
+            if topk is not None: q.topk = topk
+            ped,pedlist = q.readPedigree(path,0,False)
+            if len(pedlist) == 0: raise QueryError(400,'No samples in the query\n')
+            rows = self.reserve(len(pedlist))
+            for sample,irow in zip(pedlist,rows): ped[sample]['rank'] = irow
+            q.clearGenos(rows)
+            q.readGenoFile(path,ped)
+            q.ped,q.pedlist = ped,pedlist
+            q.ped1,q.names1 = ped,pedlist
+            q.ped2,q.names2 = self.gen.ped1,self.gen.names1
+            fout = StringIO()
+            if mode == 'check': q.checkPed(fout)
+            elif mode == 'findparent': q.findParent(fout,limit)
+            elif mode == 'findped': q.findPed(fout,limit)
+            elif mode == 'dup':
+                # The query samples first, every one is paired with all later samples
+                q.ped2 = dict(self.gen.ped1)
+                q.ped2.update(ped)
+                q.ped = q.ped2
+                q.pedlist = pedlist+[sample for sample in self.gen.names1 if sample not in ped]
+                q.findDupBlockShard(fout,list(range(len(pedlist))),limit)
+            with self.rows: self.queries += 1
+            return fout.getvalue()
+        finally:
+            if rows: self.release(rows)
+            os.remove(path)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Answers Expect: 100-continue at once, clients otherwise wait before sending large queries
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.strip('/') != 'status': return self.reply(404,'Unknown path: %s\n' % url.path)
+        self.reply(200,json.dumps(self.server.panel.status(),indent=1,sort_keys=True)+'\n','application/json')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        mode = url.path.strip('/').lower()
+        args = dict((k,v[-1]) for k,v in parse_qs(url.query).items())
+        text = self.rfile.read(int(self.headers.get('Content-Length',0))).decode('utf-8')
+        if mode == 'reload':
+            if args: return self.reply(400,'Reload takes no parameters, the reference file given at startup is read again\n')
+            try: panel = self.server.reload()
+            except QueryError as e: return self.reply(e.status,str(e))
+            return self.reply(200,json.dumps(panel.status(),indent=1,sort_keys=True)+'\n','application/json')
+        if mode not in MODES: return self.reply(404,'Unknown mode: %s, use one of %s\n' % (mode,'/'.join(MODES)))
+        panel = self.server.panel # Kept for the whole query, a reload swaps in a new one
+        t = time.time()
+        try:
+            limit = float(args.get('limit',self.server.limit))
+            topk = int(args['top']) if 'top' in args else None
+            report = panel.query(mode,text,limit,topk)
+        except QueryError as e: return self.reply(e.status,str(e))
+        except (ValueError,KeyError,IndexError,NameError,SystemExit) as e:
+            return self.reply(400,'Could not read the query: %s\n' % repr(e))
+        if self.server.verbose: sys.stderr.write('%s: %d bytes answered in %.3f s\n' % (mode,len(report),time.time()-t))
+        self.reply(200,report)
+
+    def reply(self,status,text,ctype='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type',ctype)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address,tuple): return self.client_address[0]
+        return 'local'
+
+    def log_message(self,format,*args):
+        if self.server.verbose: BaseHTTPRequestHandler.log_message(self,format,*args)
+
+class Server(object):
+    """ Holds the current panel and replaces it on reload, mixed into the socket server classes below """
+
+    def setup(self,args):
+        self.args = args
+        self.limit = args.limit
+        self.verbose = args.verbose
+        self.reloading = threading.Lock()
+        self.panel = self.load(args.reference)
+
+    def load(self,reference):
+        panel = Panel(self.args,reference)
+        sys.stderr.write('Reference %s: %d samples, %d markers, read in %.1f s\n' % (reference,len(panel.gen.ped1),len(panel.gen.marklist),panel.seconds))
+        return panel
+
+    def reload(self):
+        # Reads the reference file again into a new panel, then swaps it in
+        if not self.reloading.acquire(False): raise QueryError(409,'A reload is already running\n')
+        try:
+            reference = self.panel.reference
+            if not os.path.isfile(reference) and not libSNP.isPlink(reference): raise QueryError(500,'No such file: %s\n' % reference)
+            try: self.panel = self.load(reference)
+            except (Exception,SystemExit) as e: raise QueryError(500,'Could not read %s, the old panel is kept: %s\n' % (reference,repr(e)))
+            return self.panel
+        finally:
+            self.reloading.release()
+
+class TCPServer(Server,ThreadingMixIn,HTTPServer):
+    daemon_threads = True
+
+class UnixServer(Server,ThreadingMixIn,UnixStreamServer):
+    daemon_threads = True
+
+def main():
+    parser = argparse.ArgumentParser(description='Keeps a reference panel in memory and answers pedcheck queries over HTTP.')
+    parser.add_argument('reference',help='Reference genotypes file, a .bed file is read as a binary Plink fileset with .bim and .fam')
+    parser.add_argument('-m','--markers',help='Marker file')
+    parser.add_argument('-n','--informat',help='Format of the genotype files (Plink/DMU/Linkage)')
+    parser.add_argument('-c',dest='infocol',type=int,help='Non-genotype columns', default=3)
+    parser.add_argument('-a',dest='allele',type=int,help='Alleleformat, 1=0/1/2, 2=11/13/33, 3=1 1/1 3/3 3', default=3)
+    parser.add_argument('-l',dest='limit',type=float,help='Noise level in percent for queries without a limit', default = 100.0)
+    parser.add_argument('-b','--blocksize',type=int,help='Samples per block in batched searches',default=256)
+    parser.add_argument('-s','--store',help='Genotype storage (float/int8/packed)',default='float')
+    parser.add_argument('--top-k',type=int,help='Findparent: only the K best parents of every sample, for queries without top',default=0)
+    parser.add_argument('--mem-limit',type=int,help='Memory budget in MB, genotypes are kept on disk (in TMPDIR) and processed in marker chunks')
+    parser.add_argument('--slots',type=int,help='Query samples held at the same time, queries wait for free rows',default=1024)
+    parser.add_argument('--host',help='Address to listen on',default='127.0.0.1')
+    parser.add_argument('--port',type=int,help='Port to listen on',default=8765)
+    parser.add_argument('--unix',help='Listen on this Unix socket instead of a TCP port')
+    parser.add_argument('-v','--verbose',action="store_true",help='Logs every request')
+    args = parser.parse_args()
+    if args.unix:
+        if os.path.exists(args.unix): os.remove(args.unix)
+        server = UnixServer(args.unix,Handler,bind_and_activate=False)
+    else:
+        server = TCPServer((args.host,args.port),Handler,bind_and_activate=False)
+    server.setup(args)
+    server.server_bind()
+    server.server_activate()
+    def hangup(signum,frame):
+        # Reloads in a thread of its own, the signal handler must return
+        threading.Thread(target=reloadQuietly,args=(server,)).start()
+    if hasattr(signal,'SIGHUP'): signal.signal(signal.SIGHUP,hangup)
+    sys.stderr.write('Listening on %s\n' % (args.unix or '%s:%d' % (args.host,args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix and os.path.exists(args.unix): os.remove(args.unix)
+
+def reloadQuietly(server):
+    try: server.reload()
+    except QueryError as e: sys.stderr.write('Reload failed: %s' % e)
+
+if __name__ == '__main__':
+    main()